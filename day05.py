@@ -4,27 +4,195 @@ import pytest
 import hashlib
 import itertools
 import random
+import collections
+import concurrent.futures
+import os
+import json
 
-def iter_digests(door_id, counter=False):
-    """Iterate through the passwords."""
-    m = hashlib.md5(door_id.encode('ascii'))
-    for i in itertools.count():
-        h = m.copy()
-        h.update(f"{i:d}".encode('ascii'))
-        digest = h.hexdigest()
-        if digest.startswith("00000"):
+class Checkpoint(object):
+    """A resumable record of mining progress, stored as JSON.
+    
+    For each door id, this records how many indices have been fully
+    scanned, and every digest starting with five zeros found so far.
+    """
+    def __init__(self, path, interval=1000000):
+        super(Checkpoint, self).__init__()
+        self.path = path
+        self.interval = interval
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+        
+    def __repr__(self):
+        return f"<Checkpoint {self.path!r} for {len(self.entries):d} door ids>"
+        
+    def scanned(self, door_id):
+        """How many indices have been scanned for this door id."""
+        return self.entries.get(door_id, {}).get("scanned", 0)
+        
+    def hits(self, door_id):
+        """The (index, digest) hits found so far for this door id."""
+        return [ tuple(hit) for hit in self.entries.get(door_id, {}).get("digests", []) ]
+        
+    def record(self, door_id, scanned, hits=()):
+        """Record progress, and any new hits below scanned."""
+        entry = self.entries.setdefault(door_id, {"scanned": 0, "digests": []})
+        entry["digests"].extend([i, digest] for i, digest in hits if i >= entry["scanned"])
+        entry["scanned"] = max(entry["scanned"], scanned)
+        
+    def save(self):
+        """Save the checkpoint file, atomically."""
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, self.path)
+        
+def iter_digests(door_id, counter=False, processes=1, checkpoint=None):
+    """Iterate through the passwords.
+    
+    With more than one process (or None, for one per CPU), blocks of
+    indices are mined in parallel by :func:`iter_hits_parallel`. With a
+    :class:`Checkpoint`, hits already found are replayed, and mining picks
+    up from the last index scanned.
+    """
+    start = 0
+    if checkpoint is not None:
+        for i, digest in checkpoint.hits(door_id):
             yield digest
-        if counter and i % counter == 0:
-            yield None
+        start = checkpoint.scanned(door_id)
+        
+    # Progress markers are needed to checkpoint, even without a counter.
+    every = counter or (checkpoint.interval if checkpoint is not None else False)
+    if processes != 1:
+        hits = iter_hits_parallel(door_id, start, counter=every, processes=processes)
+    else:
+        hits = iter_hits(door_id, start, counter=every)
+        
+    scanned = saved = start
+    try:
+        for i, digest in hits:
+            scanned = i + 1
+            if digest is not None:
+                if checkpoint is not None:
+                    checkpoint.record(door_id, scanned, [(i, digest)])
+                    checkpoint.save()
+                    saved = scanned
+                yield digest
+            else:
+                if checkpoint is not None and scanned - saved >= checkpoint.interval:
+                    checkpoint.record(door_id, scanned)
+                    checkpoint.save()
+                    saved = scanned
+                if counter:
+                    yield None
+    finally:
+        hits.close()
+        if checkpoint is not None:
+            checkpoint.record(door_id, scanned)
+            checkpoint.save()
+    
+# Decimal suffixes for the last two digits of an index.
+SMALL_SUFFIXES = [ f"{i:d}".encode('ascii') for i in range(100) ]
+SUFFIXES = [ f"{i:02d}".encode('ascii') for i in range(100) ]
+
+# A digest starts with five zero nibbles iff it sorts below this.
+FIVE_ZEROS = b"\x00\x00\x10"
+
+def iter_prefixes(base, start=0, stop=None):
+    """Iterate through hashes for blocks of up to 100 consecutive indices.
+    
+    Yields (first index, hash, suffixes), where the hash has been updated
+    with all but the last two digits of the indices in the block, and the
+    suffixes are the encoded remaining digits. This saves encoding each index.
+    """
+    for p in itertools.count(start // 100):
+        lo = max(start - p * 100, 0)
+        hi = 100 if stop is None else min(stop - p * 100, 100)
+        if hi <= lo:
+            return
+        if p:
+            h = base.copy()
+            h.update(f"{p:d}".encode('ascii'))
+            yield p * 100 + lo, h, SUFFIXES[lo:hi]
+        else:
+            yield lo, base, SMALL_SUFFIXES[lo:hi]
+    
+def test_iter_prefixes():
+    """Test that prefixes and suffixes make each index."""
+    base = hashlib.md5(b"abc")
+    hashes = []
+    for first, h, suffixes in iter_prefixes(base, 95, 1205):
+        for offset, suffix in enumerate(suffixes):
+            hh = h.copy()
+            hh.update(suffix)
+            hashes.append((first + offset, hh.hexdigest()))
+    assert [ i for i, _ in hashes ] == list(range(95, 1205))
+    assert all(digest == hashlib.md5(f"abc{i:d}".encode('ascii')).hexdigest() for i, digest in hashes)
+    
+def iter_hits(door_id, start=0, counter=False, stop=None):
+    """Iterate through (index, digest) pairs starting with five zeros.
+    
+    Only the raw digest is checked, and hex digests are made for hits.
+    With a counter, (index, None) is yielded after each block of indices
+    which includes a multiple of counter. Without a stop, this never ends.
+    """
+    m = hashlib.md5(door_id.encode('ascii'))
+    for first, prefix, suffixes in iter_prefixes(m, start, stop):
+        for offset, suffix in enumerate(suffixes):
+            h = prefix.copy()
+            h.update(suffix)
+            if h.digest() < FIVE_ZEROS:
+                yield first + offset, h.hexdigest()
+        last = first + len(suffixes) - 1
+        if counter and (last // counter) > ((first - 1) // counter):
+            yield last, None
             
-def iter_simple_codes(door_id):
+def mine_block(door_id, start, stop):
+    """Find the (index, digest) pairs which start with five zeros in a block of indices."""
+    return list(iter_hits(door_id, start, stop=stop))
+    
+def iter_hits_parallel(door_id, start=0, counter=False, processes=None, blocksize=100000):
+    """Iterate through (index, digest) pairs, mining contiguous blocks in a process pool.
+    
+    Blocks are handed out in order and their hits are yielded in index
+    order, so the sequence matches :func:`iter_hits`. With a counter,
+    (index, None) is yielded after each block, for its last index.
+    """
+    processes = processes or os.cpu_count()
+    pool = concurrent.futures.ProcessPoolExecutor(processes)
+    try:
+        starts = itertools.count(start, blocksize)
+        pending = collections.deque()
+        for block in itertools.islice(starts, 2 * processes):
+            pending.append((block, pool.submit(mine_block, door_id, block, block + blocksize)))
+        while True:
+            block, future = pending.popleft()
+            hits = future.result()
+            nxt = next(starts)
+            pending.append((nxt, pool.submit(mine_block, door_id, nxt, nxt + blocksize)))
+            yield from hits
+            if counter:
+                yield block + blocksize - 1, None
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+    
+def test_mine_block():
+    """Test mining a block against the serial iterator."""
+    assert mine_block("abc", 3231920, 3231940) == [(3231929, "00000155f8105dff7f56ee10fa9b9abd")]
+    assert mine_block("abc", 0, 1000) == []
+            
+def iter_simple_codes(door_id, processes=1, checkpoint=None):
     """Iterate through simple door codes."""
-    for digest in iter_digests(door_id):
+    for digest in iter_digests(door_id, processes=processes, checkpoint=checkpoint):
         yield digest[5]
     
-def find_password(door_id, length):
+def find_password(door_id, length, processes=1, checkpoint=None):
     """Find the first n items."""
-    return "".join(itertools.islice(iter_simple_codes(door_id), length))
+    codes = iter_simple_codes(door_id, processes=processes, checkpoint=checkpoint)
+    password = "".join(itertools.islice(codes, length))
+    codes.close()
+    return password
     
 def test_find_password():
     """A test for finding the password."""
@@ -42,12 +210,13 @@ def show_password(password):
             output.append(c)
     print(" Decrypting " + ("".join(output)) + "\r", end="")
     
-def find_complex_door_codes(door_id, length, show=True):
+def find_complex_door_codes(door_id, length, show=True, processes=1, checkpoint=None):
     """Iterate through complex door codes which appear."""
     password = ["_"] * length
     if show:
         print(" Decrypting " + "".join(password) + "\r", end="")
-    for digest in iter_digests(door_id, counter=10000):
+    digests = iter_digests(door_id, counter=10000, processes=processes, checkpoint=checkpoint)
+    for digest in digests:
         if digest is None:
             if show:
                 show_password(password)
@@ -58,6 +227,7 @@ def find_complex_door_codes(door_id, length, show=True):
                 password[index] = digest[6]
             if not any(p == "_" for p in password):
                 break
+    digests.close()
     if show:
         show_password(password)
         print("")
@@ -66,15 +236,36 @@ def find_complex_door_codes(door_id, length, show=True):
 def test_complex_password():
     """Test a complex password."""
     assert find_complex_door_codes("abc", 8, show=False) == "05ace8e3"
+    
+def test_checkpoint(tmp_path):
+    """Test resuming from a checkpoint."""
+    path = str(tmp_path / "day05.json")
+    checkpoint = Checkpoint(path)
+    # Pretend we've already found a hit, and scanned almost to the next one.
+    checkpoint.record("abc", 3231900, [(7, "00000a" + "0" * 26)])
+    assert find_password("abc", 2, checkpoint=checkpoint) == "a1"
+    
+    checkpoint = Checkpoint(path)
+    assert checkpoint.scanned("abc") == 3231930
+    assert checkpoint.hits("abc") == [(7, "00000a" + "0" * 26), (3231929, "00000155f8105dff7f56ee10fa9b9abd")]
+    assert find_password("abc", 2, checkpoint=checkpoint) == "a1"
+    assert Checkpoint(path).scanned("abc") == 3231930
+    assert Checkpoint(path).scanned("abd") == 0
+    
+def test_parallel_passwords():
+    """Test the parallel miner gives the same passwords."""
+    assert find_password("abc", 3, processes=2) == "18f"
+    assert find_complex_door_codes("abc", 8, show=False, processes=2) == "05ace8e3"
 
 if __name__ == '__main__':
     print("Puzzle #1")
     door_id = "wtnhxymk"
-    password = find_password(door_id, 8)
+    checkpoint = Checkpoint("day05_checkpoint.json")
+    password = find_password(door_id, 8, checkpoint=checkpoint)
     print(f"The password for {door_id} is {password}")
     
     print("Puzzle #2")
-    password = find_complex_door_codes(door_id, 8, show=True)
+    password = find_complex_door_codes(door_id, 8, show=True, checkpoint=checkpoint)
     print(f"The password for {door_id} is {password}")
     
     
@@ -3,7 +3,268 @@
 import pytest
 import collections
 import itertools
+import concurrent.futures
+import os
+import heapq
+import random
 
+def _expand_states(n, npairs, states):
+    """Expand a shard of states, mapping each new state to a predecessor.
+    
+    This runs in worker processes, so it only passes integers around.
+    """
+    building = Building(n, npairs)
+    found = {}
+    for state in states:
+        for m in building.moves(state):
+            found.setdefault(m, state)
+    return found
+    
+class Building(object):
+    """A compact integer encoding of building states for searching.
+    
+    A state packs the elevator floor into the low bits, followed by the
+    sorted (generator floor, microchip floor) pairs, so that states which
+    differ only by element names share an encoding. Floors are zero-indexed.
+    """
+    def __init__(self, n, npairs):
+        super(Building, self).__init__()
+        self.n = int(n)
+        self.npairs = int(npairs)
+        self.bits = max(1, (self.n - 1).bit_length())
+        self.mask = (1 << self.bits) - 1
+        top = self.n - 1
+        self.final = self.encode(top, [(top, top)] * self.npairs)
+        
+    def __repr__(self):
+        return f"<Building with {self.n:d} floors and {self.npairs:d} pairs>"
+    
+    def encode(self, elevator, pairs):
+        """Encode the elevator floor and (generator, microchip) floor pairs."""
+        bits = self.bits
+        state = 0
+        for g, m in sorted(pairs, reverse=True):
+            state = (state << (2 * bits)) | (g << bits) | m
+        return (state << bits) | elevator
+        
+    def decode(self, state):
+        """Decode a state into the elevator floor and sorted pairs."""
+        bits, mask = self.bits, self.mask
+        elevator = state & mask
+        pairs = []
+        for i in range(self.npairs):
+            state >>= bits
+            m = state & mask
+            state >>= bits
+            pairs.append((state & mask, m))
+        return elevator, pairs
+        
+    def done(self, state):
+        """Is everything on the top floor?"""
+        return (state >> self.bits) == (self.final >> self.bits)
+    
+    def moves(self, state, prune=True):
+        """Iterate over the states reachable in one move from state.
+        
+        Each floor is a bitmask of generators and a bitmask of microchips,
+        indexed by pair, so legality is a couple of bit operations. When
+        pruning, nothing moves down to empty floors, which never shortens a
+        path. Without pruning, moves are reversible.
+        """
+        elevator, pairs = self.decode(state)
+        npairs = self.npairs
+        gens = [0] * self.n
+        chips = [0] * self.n
+        for i, (g, m) in enumerate(pairs):
+            gens[g] |= 1 << i
+            chips[m] |= 1 << i
+            
+        # Chips occupy the high bits of the items on this floor.
+        here = gens[elevator] | (chips[elevator] << npairs)
+        items = [ 1 << k for k in range(2 * npairs) if (here >> k) & 1 ]
+        
+        destinations = []
+        if elevator > 0 and (not prune or any(gens[f] | chips[f] for f in range(elevator))):
+            destinations.append(elevator - 1)
+        if elevator < self.n - 1:
+            destinations.append(elevator + 1)
+        
+        pmask = (1 << npairs) - 1
+        for things in itertools.chain(items, (a | b for a, b in itertools.combinations(items, 2))):
+            mg = things & pmask
+            mc = things >> npairs
+            ge = gens[elevator] & ~mg
+            ce = chips[elevator] & ~mc
+            if ge and (ce & ~ge):
+                continue
+            for destination in destinations:
+                gd = gens[destination] | mg
+                cd = chips[destination] | mc
+                if gd and (cd & ~gd):
+                    continue
+                moved = [ (destination if (mg >> i) & 1 else g, destination if (mc >> i) & 1 else m) for i, (g, m) in enumerate(pairs) ]
+                yield self.encode(destination, moved)
+    
+    def heuristic(self, state):
+        """A lower bound on the moves left.
+        
+        Each move carries at most two items up one floor, so it takes at
+        least half the total floors each item is below the top.
+        """
+        elevator, pairs = self.decode(state)
+        below = 2 * (self.n - 1) * self.npairs - sum(g + m for g, m in pairs)
+        return (below + 1) // 2
+        
+    def search(self, start, strategy="bfs", verbose=True, **options):
+        """Search from start to the finished state.
+        
+        Returns the finished state and a map from each visited state to its
+        predecessor (None for start), from which :meth:`path` recovers a
+        shortest path.
+        """
+        strategies = {
+            "bfs": self.bfs,
+            "astar": self.astar,
+            "bidirectional": self.bidirectional,
+            "parallel": self.parallel_bfs,
+        }
+        if strategy not in strategies:
+            raise ValueError(f"Unknown search strategy {strategy!r}, expected one of {', '.join(strategies)}")
+        if self.done(start):
+            return start, {start: None}
+        return strategies[strategy](start, verbose=verbose, **options)
+        
+    @staticmethod
+    def path(predecessors, state):
+        """The list of states leading to state, from the start."""
+        states = []
+        while state is not None:
+            states.append(state)
+            state = predecessors[state]
+        return states[::-1]
+    
+    def bfs(self, start, verbose=True):
+        """Generational breadth first search."""
+        predecessors = {start: None}
+        to_check = [start]
+        for gen in itertools.count(1):
+            next_to_check = []
+            for state in to_check:
+                if self.done(state):
+                    return state, predecessors
+                for m in self.moves(state):
+                    if m not in predecessors:
+                        predecessors[m] = state
+                        next_to_check.append(m)
+            to_check = next_to_check
+            if verbose:
+                print(f"Generation {gen:d}, seen {len(predecessors):,d} states, queued {len(to_check):,d}.")
+            if not len(to_check):
+                break
+        raise ValueError("Exhausted search, can't find a solution.")
+        
+    def parallel_bfs(self, start, verbose=True, processes=None, serial=1000):
+        """Generational breadth first search, expanding in a process pool.
+        
+        Each generation is split into shards for the workers, whose new
+        states are merged into the predecessor map here. Generations smaller
+        than serial are expanded in this process.
+        """
+        processes = processes or os.cpu_count()
+        predecessors = {start: None}
+        to_check = [start]
+        with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+            for gen in itertools.count(1):
+                for state in to_check:
+                    if self.done(state):
+                        return state, predecessors
+                if len(to_check) < serial:
+                    results = [_expand_states(self.n, self.npairs, to_check)]
+                else:
+                    size = -(-len(to_check) // (4 * processes))
+                    shards = [ to_check[i:i + size] for i in range(0, len(to_check), size) ]
+                    results = pool.map(_expand_states, itertools.repeat(self.n), itertools.repeat(self.npairs), shards)
+                next_to_check = []
+                for found in results:
+                    for m, state in found.items():
+                        if m not in predecessors:
+                            predecessors[m] = state
+                            next_to_check.append(m)
+                to_check = next_to_check
+                if verbose:
+                    print(f"Generation {gen:d}, seen {len(predecessors):,d} states, queued {len(to_check):,d}.")
+                if not len(to_check):
+                    break
+        raise ValueError("Exhausted search, can't find a solution.")
+        
+    def astar(self, start, verbose=True):
+        """A* search, using :meth:`heuristic`."""
+        tiebreak = itertools.count()
+        predecessors = {start: None}
+        best = {start: 0}
+        closed = set()
+        to_check = [(self.heuristic(start), 0, next(tiebreak), start)]
+        while to_check:
+            f, g, _, state = heapq.heappop(to_check)
+            if state in closed:
+                continue
+            closed.add(state)
+            if self.done(state):
+                return state, predecessors
+            if verbose and len(closed) % 100000 == 0:
+                print(f"Expanded {len(closed):,d} states, f={f:d}, queued {len(to_check):,d}.")
+            for m in self.moves(state):
+                if m not in closed and best.get(m, g + 2) > g + 1:
+                    best[m] = g + 1
+                    predecessors[m] = state
+                    heapq.heappush(to_check, (g + 1 + self.heuristic(m), g + 1, next(tiebreak), m))
+        raise ValueError("Exhausted search, can't find a solution.")
+        
+    def bidirectional(self, start, verbose=True):
+        """Breadth first search from both ends, expanding the smaller side.
+        
+        This uses reversible (unpruned) moves, so that the same moves lead
+        back from the finished state.
+        """
+        # Each side maps a state to its neighbour towards that side's origin,
+        # and to its depth from that origin.
+        sides = [{start: None}, {self.final: None}]
+        depths = [{start: 0}, {self.final: 0}]
+        frontiers = [[start], [self.final]]
+        meeting = None
+        for gen in itertools.count(1):
+            if meeting is not None:
+                break
+            side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+            links, others = sides[side], sides[1 - side]
+            depth, other_depth = depths[side], depths[1 - side]
+            best = None
+            next_frontier = []
+            for state in frontiers[side]:
+                for m in self.moves(state, prune=False):
+                    if m in links:
+                        continue
+                    links[m] = state
+                    depth[m] = depth[state] + 1
+                    next_frontier.append(m)
+                    if m in others and (best is None or other_depth[m] < best[0]):
+                        best = (other_depth[m], m)
+            frontiers[side] = next_frontier
+            if verbose:
+                print(f"Generation {gen:d}, seen {len(links) + len(others):,d} states, queued {len(next_frontier):,d}.")
+            if best is not None:
+                meeting = best[1]
+            elif not next_frontier:
+                raise ValueError("Exhausted search, can't find a solution.")
+        
+        # Splice the backward links onto the forward predecessors.
+        predecessors, successors = sides
+        state = meeting
+        while successors[state] is not None:
+            predecessors[successors[state]] = state
+            state = successors[state]
+        return self.final, predecessors
+    
 class Floors(object):
     """An object to represent the state of the floors."""
     def __init__(self, n):
@@ -16,7 +277,8 @@ class Floors(object):
         # What floor is the elevator on?
         self.elevator = 1
         
-        self.previous = None
+        # Map from encoded states to their predecessors on a path.
+        self.predecessors = None
     
     def __repr__(self):
         return f"<Floors with {self.n:d} floors, {len(self.things)} items and E{self.elevator:d}>"
@@ -29,33 +291,41 @@ class Floors(object):
     def __setitem__(self, key, value):
         self.things[key] = int(value)
         
-    def _paired_items(self):
-        """Paired items."""
-        for item, floor in self.things.items():
-            if item[1] == "G":
-                if self.things[item[0] + "M"] == floor:
-                    yield "-P", floor
-                else:
-                    yield item, floor
-            if item[1] == "M" and self.things[item[0] + "G"] != floor:
-                yield item, floor
-            
+    def elements(self):
+        """The element labels, in sorted order."""
+        return sorted({ item[0] for item in self.things })
+        
+    def building(self):
+        """The building for searching over encoded states."""
+        return Building(self.n, len(self.elements()))
+        
+    def encode(self):
+        """Encode this state as an integer."""
+        pairs = [ (self.things[e + "G"] - 1, self.things[e + "M"] - 1) for e in self.elements() ]
+        return self.building().encode(self.elevator - 1, pairs)
+        
+    def decode(self, state):
+        """Make a new state from an integer encoding.
         
-    def _thing_state(self):
-        """State of things"""
-        if not hasattr(self, '_thing_state_cache'):
-            self._thing_state_cache = list(sorted(self._paired_items()))
-        return self._thing_state_cache
+        Element labels are assigned to the sorted pairs in sorted order.
+        """
+        elevator, pairs = self.building().decode(state)
+        fnew = self.__class__(self.n)
+        fnew.elevator = elevator + 1
+        for element, (g, m) in zip(self.elements(), pairs):
+            fnew[element + "G"] = g + 1
+            fnew[element + "M"] = m + 1
+        return fnew
         
     def __eq__(self, other):
-        return (other.elevator == self.elevator) and (other._thing_state() == self._thing_state())
+        return (self.n == other.n) and (self.encode() == other.encode())
         
     def __hash__(self):
-        return hash((self.elevator, tuple(self._thing_state())))
+        return hash(self.encode())
         
     def done(self):
         """Is this state complete?"""
-        return all(v == 4 for v in self.things.values())
+        return all(v == self.n for v in self.things.values())
         
     def floors(self):
         """Return a mapping from floor number to items."""
@@ -101,78 +371,63 @@ class Floors(object):
         return fnew
     
     def moves(self):
-        """Iterate over possible moves from this state."""
-        floors = self.floors()
-        on_this_floor = floors[self.elevator]
-        
-        # We are at the final floor, don't move any finished pairs off of this floor?
-        if self.elevator == self.n:
-            # generators = { thing[0] for thing in on_this_floor if thing[1] == "G" }
-            for thing in list(on_this_floor):
-                if thing[1] == "M" and (thing[0] + "G") in on_this_floor:
-                    on_this_floor.remove(thing)
-                    on_this_floor.remove(thing[0] + "G")
-        
-        to_move = [ [t] for t in on_this_floor]
-        for things in itertools.chain(to_move, itertools.combinations(on_this_floor, 2)):
-            destinations = []
-            if self.elevator > 1:
-                if any(len(floors[f]) for f in range(1,self.elevator)):
-                    destinations.append(self.elevator - 1)
-            if self.elevator < self.n:
-                destinations.append(self.elevator + 1)
-            for destination in destinations:
-                new = self.copy()
-                new.previous = self
-                new.elevator = destination
-                for thing in things:
-                    new.things[thing] = destination
-                if self.previous and new == self.previous:
-                    continue
-                if not new.dangerops():
-                    yield new
-        
-    def search(self):
-        """Search for a done state."""
-        to_check = collections.deque()
-        seen = set([hash(self)])
-        for m in self.moves():
-            seen.add(hash(m))
-            to_check.append(m)
-        generation = 0
-        try:
-            for gen in itertools.count(1):
-                next_to_check = []
-                while len(to_check):
-                    move = to_check.popleft()
-                    if move.done():
-                        return move
-                    for m in move.moves():
-                        hm = hash(m)
-                        if hm not in seen:
-                            seen.add(hm)
-                            next_to_check.append(m)
-                to_check.extend(next_to_check)
-                print(f"Generation {gen:d}, seen {len(seen):,d} states, queued {len(to_check):,d}.")
-                if not len(to_check):
-                    break
-        except KeyboardInterrupt:
-            print("-" * 10)
-            print(move.to_string())
-            raise
-        raise ValueError("Exhausted search, can't find a solution.")
+        """Iterate over possible moves from this state.
+        
+        New states share this state's predecessor map, with this state as
+        their predecessor unless they are already on a recorded path.
+        """
+        state = self.encode()
+        if self.predecessors is None:
+            self.predecessors = {state: None}
+        previous = self.predecessors.get(state)
+        for m in self.building().moves(state):
+            if m == previous:
+                continue
+            self.predecessors.setdefault(m, state)
+            new = self.decode(m)
+            new.predecessors = self.predecessors
+            yield new
+        
+    def search(self, strategy="bfs", verbose=True, **options):
+        """Search for a done state.
+        
+        The strategy is one of "bfs", "astar", "bidirectional" or "parallel",
+        and options are passed on to the strategy (see :class:`Building`).
+        """
+        state, predecessors = self.building().search(self.encode(), strategy=strategy, verbose=verbose, **options)
+        end = self.decode(state)
+        end.predecessors = predecessors
+        return end
+        
+    @property
+    def previous(self):
+        """The previous state on the path, if any."""
+        if self.predecessors is None:
+            return None
+        state = self.predecessors.get(self.encode())
+        if state is None:
+            return None
+        previous = self.decode(state)
+        previous.predecessors = self.predecessors
+        return previous
+        
+    def _path(self):
+        """Encoded states on the path to here."""
+        state = self.encode()
+        if self.predecessors is None or state not in self.predecessors:
+            return [state]
+        return Building.path(self.predecessors, state)
         
     def pathlength(self):
         """Length of the path."""
-        if self.previous is None:
-            return 0
-        return 1 + self.previous.pathlength()
+        return len(self._path()) - 1
     
     def iterpath(self):
         """Iterate path."""
-        if self.previous is not None:
-            yield from self.previous.iterpath()
-        yield self
+        for state in self._path():
+            f = self.decode(state)
+            f.predecessors = self.predecessors
+            yield f
     
 def test_floors():
     """Test floors basics"""
@@ -200,6 +455,139 @@ def test_example():
     assert not f.dangerops()
     assert f.search().pathlength() == 11
     
+@pytest.mark.parametrize("strategy", ["bfs", "astar", "bidirectional"])
+def test_search_strategies(strategy):
+    """Test that each strategy finds a shortest path."""
+    f = Floors(4)
+    f['HG'] = 2
+    f['HM'] = 1
+    f['LG'] = 3
+    f['LM'] = 1
+    end = f.search(strategy=strategy, verbose=False)
+    assert end.done()
+    assert end.pathlength() == 11
+    states = [ s.encode() for s in end.iterpath() ]
+    assert states[0] == f.encode()
+    building = f.building()
+    for a, b in zip(states[:-1], states[1:]):
+        assert b in set(building.moves(a, prune=False))
+    assert PUZZLE_FLOORS.search(strategy=strategy, verbose=False).pathlength() == 37
+    
+def shortest_length(building, start):
+    """The shortest path length over unpruned moves, or None."""
+    depths = {start: 0}
+    queue = collections.deque([start])
+    while queue:
+        state = queue.popleft()
+        if building.done(state):
+            return depths[state]
+        for m in building.moves(state, prune=False):
+            if m not in depths:
+                depths[m] = depths[state] + 1
+                queue.append(m)
+    return None
+    
+def random_floors(rng):
+    """A random, safe arrangement of floors."""
+    while True:
+        f = Floors(rng.randint(3, 5))
+        f.elevator = rng.randint(1, f.n)
+        for element in "ABC"[:rng.randint(1, 3)]:
+            f[element + 'G'] = rng.randint(1, f.n)
+            f[element + 'M'] = rng.randint(1, f.n)
+        if not f.dangerops():
+            return f
+    
+def test_strategies_agree():
+    """Test that every strategy finds the shortest path, off the puzzle inputs."""
+    f = Floors(4)
+    f.elevator = 2
+    for item, floor in dict(AG=2, AM=4, BG=2, BM=4, CG=3, CM=1).items():
+        f[item] = floor
+    
+    done = Floors(4)
+    done.elevator = 2
+    done['AG'] = done['AM'] = 4
+    
+    rng = random.Random(11)
+    cases = [f, done] + [ random_floors(rng) for i in range(60) ]
+    for f in cases:
+        building = f.building()
+        expected = shortest_length(building, f.encode())
+        for strategy in ["bfs", "astar", "bidirectional"]:
+            if expected is None:
+                with pytest.raises(ValueError):
+                    f.search(strategy=strategy, verbose=False)
+            else:
+                end = f.search(strategy=strategy, verbose=False)
+                assert end.done()
+                assert end.pathlength() == expected, (f.to_string(), strategy)
+    assert shortest_length(cases[0].building(), cases[0].encode()) == 12
+    assert done.search(strategy="bidirectional", verbose=False).pathlength() == 0
+    
+def test_floors_done():
+    """Test finishing with more than four floors."""
+    f = Floors(5)
+    f['AG'] = f['AM'] = 5
+    assert f.done()
+    f['AM'] = 4
+    assert not f.done()
+    
+def test_parallel_search():
+    """Test searching with a process pool."""
+    end = PUZZLE_FLOORS.search(strategy="parallel", verbose=False, processes=2, serial=0)
+    assert end.pathlength() == 37
+    assert end.done()
+    
+def test_long_path():
+    """Test paths longer than the recursion limit."""
+    predecessors = dict(zip(range(1, 5001), range(0, 5000)))
+    predecessors[0] = None
+    assert Building.path(predecessors, 5000)[:3] == [0, 1, 2]
+    assert len(Building.path(predecessors, 5000)) == 5001
+    
+def test_moves_path():
+    """Test paths through moves."""
+    f = Floors(4)
+    f['HG'] = 2
+    f['HM'] = 1
+    f['LG'] = 3
+    f['LM'] = 1
+    for m in f.moves():
+        assert m.pathlength() == 1
+        assert m.previous == f
+        assert all(n != f for n in m.moves())
+    
+def test_search_unknown_strategy():
+    """Test an unknown strategy."""
+    with pytest.raises(ValueError):
+        Floors(4).search(strategy="dfs")
+    
+def test_building():
+    """Test encoding states."""
+    b = Building(4, 2)
+    state = b.encode(0, [(2, 0), (1, 0)])
+    assert b.decode(state) == (0, [(1, 0), (2, 0)])
+    assert state == b.encode(0, [(1, 0), (2, 0)])
+    assert not b.done(state)
+    assert b.done(b.encode(3, [(3, 3), (3, 3)]))
+    # Only the first chip can safely join its generator.
+    assert [b.decode(m) for m in b.moves(state)] == [(1, [(1, 1), (2, 0)])]
+    
+def test_encode():
+    """Test that states which differ by element share an encoding."""
+    f = Floors(4)
+    f['HG'] = 2
+    f['HM'] = 1
+    f['LG'] = 3
+    f['LM'] = 1
+    g = f.copy()
+    g['HG'] = 3
+    g['LG'] = 2
+    assert f == g
+    assert f.decode(f.encode()) == f
+    assert f.decode(f.encode()).to_string() == f.to_string()
+    
 PUZZLE_INPUT = """
 The first floor contains a strontium generator, a strontium-compatible microchip, a plutonium generator, and a plutonium-compatible microchip.
 The second floor contains a thulium generator, a ruthenium generator, a ruthenium-compatible microchip, a curium generator, and a curium-compatible microchip.
@@ -4,6 +4,9 @@ Day 12: Assembler
 """
 
 import collections
+import collections.abc
+import time
+import pytest
 
 class Registers(dict):
     """The assembly registers"""
@@ -29,31 +32,179 @@ class Registers(dict):
         self[target] -= 1
     
     
-def parse(commands, registers):
-    """Parse commands"""
+class RegisterFile(collections.abc.MutableMapping):
+    """Registers stored in fixed integer slots.
+    
+    Compiled commands index into :attr:`slots` directly, while the
+    mapping interface (``r['a']``) is a thin view over those slots.
+    """
+    
+    def __init__(self, names):
+        super(RegisterFile, self).__init__()
+        self.names = tuple(names)
+        self.index = { name:i for i, name in enumerate(self.names) }
+        self.slots = [0] * len(self.names)
+    
+    @classmethod
+    def fromkeys(cls, names, value=0):
+        """Make a register file with each register set to value."""
+        r = cls(names)
+        r.slots[:] = [value] * len(r.names)
+        return r
+        
+    @classmethod
+    def from_mapping(cls, mapping):
+        """Make a register file from an existing mapping of registers."""
+        r = cls(mapping.keys())
+        r.slots[:] = mapping.values()
+        return r
+    
+    def __repr__(self):
+        return repr(dict(self))
+    
+    def __getitem__(self, key):
+        return self.slots[self.index[key]]
+        
+    def __setitem__(self, key, value):
+        self.slots[self.index[key]] = value
+        
+    def __delitem__(self, key):
+        raise TypeError("Can't remove a register from a register file.")
+    
+    def __contains__(self, key):
+        return key in self.index
+        
+    def __iter__(self):
+        return iter(self.names)
+        
+    def __len__(self):
+        return len(self.names)
+    
+class Profile(object):
+    """An instruction level profile of a running program."""
+    def __init__(self):
+        super(Profile, self).__init__()
+        self.commands = {}
+        self.counts = collections.Counter()
+        self.calls = collections.Counter()
+        self.times = collections.Counter()
+        self.back_edges = collections.Counter()
+        
+    def wrap(self, position, command, opcode, op):
+        """Wrap a compiled command to record its execution."""
+        self.commands[position] = command
+        counts, calls, times, back_edges = self.counts, self.calls, self.times, self.back_edges
+        timer = time.perf_counter
+        def profiled():
+            start = timer()
+            nxt = op()
+            times[opcode] += timer() - start
+            calls[opcode] += 1
+            counts[position] += 1
+            if nxt <= position:
+                back_edges[(position, nxt)] += 1
+            return nxt
+        return profiled
+        
+    def report(self, top=10):
+        """Report on the profile."""
+        output = [f"Executed {sum(self.counts.values()):,d} instructions."]
+        output.append("Opcodes:")
+        for opcode, calls in self.calls.most_common():
+            t = self.times[opcode]
+            output.append(f"  {opcode:4s} {calls:15,d} calls {t:10.3f}s {t / calls * 1e9:8.1f}ns/call")
+        output.append("Hot instructions:")
+        for position, count in self.counts.most_common(top):
+            output.append(f"  {position:4d} {self.commands[position]:15s} {count:15,d}")
+        output.append("Hot loop back edges:")
+        for (back, head), count in self.back_edges.most_common(top):
+            body = "; ".join(self.commands.get(p, "?") for p in range(head, back + 1))
+            output.append(f"  {back:4d} -> {head:4d} {count:15,d} [{body}]")
+        return "\n".join(output)
+        
+def compile_command(command, position, registers):
+    """Compile a single command into a closure.
+    
+    Operands are resolved once, here, into either a register slot or an
+    integer constant. The closure applies the command and returns the next
+    position to execute.
+    """
+    slots = registers.slots
+    index = registers.index
+    cmd = command[:3]
+    args = command[3:].split()
+    nxt = position + 1
+    if cmd == "cpy":
+        src, dest = args
+        d = index[dest]
+        if src in index:
+            s = index[src]
+            def op():
+                slots[d] = slots[s]
+                return nxt
+        else:
+            value = int(src)
+            def op():
+                slots[d] = value
+                return nxt
+    elif cmd == "inc":
+        t = index[args[0]]
+        def op():
+            slots[t] += 1
+            return nxt
+    elif cmd == "dec":
+        t = index[args[0]]
+        def op():
+            slots[t] -= 1
+            return nxt
+    elif cmd == "jnz":
+        src, offset = args
+        jump = position + int(offset)
+        if src in index:
+            s = index[src]
+            def op():
+                if slots[s] != 0:
+                    return jump
+                return nxt
+        elif int(src) != 0:
+            def op():
+                return jump
+        else:
+            def op():
+                return nxt
+    else:
+        raise ValueError(f"Can't parse command {command}")
+    return op
+    
+def compile_program(commands, registers, profile=None):
+    """Compile commands into a list of closures over a register file.
+    
+    If a :class:`Profile` is given, each closure records its execution there.
+    """
     commands = [command.strip() for command in commands if command.strip()]
+    program = [compile_command(command, position, registers) for position, command in enumerate(commands)]
+    if profile is not None:
+        program = [ profile.wrap(position, command, command[:3], op) for position, (command, op) in enumerate(zip(commands, program)) ]
+    return program
+    
+def run(program):
+    """Run a compiled program."""
     position = 0
-    n = 0
-    while position < len(commands):
-        command = commands[position]
-        n += 1
-        cmd = command[:3]
-        args = command[3:].split()
-        if cmd == "cpy":
-            registers.cpy(*args)
-        elif cmd == "inc":
-            registers.inc(*args)
-        elif cmd == "dec":
-            registers.dec(*args)
-        elif cmd == "jnz":
-            if registers.val(args[0]) != 0:
-                # print(command + f" | {registers} | {position}")
-                position += int(args[1])
-                continue
-        else:
-            raise ValueError(f"Can't parse command {command}")
-        # print(command + f" | {registers} | {position}")
-        position += 1
+    n = len(program)
+    while position < n:
+        position = program[position]()
+    
+def parse(commands, registers, profile=None):
+    """Parse commands, printing a report if a profile is given."""
+    if isinstance(registers, RegisterFile):
+        regfile = registers
+    else:
+        regfile = RegisterFile.from_mapping(registers)
+    run(compile_program(commands, regfile, profile=profile))
+    if regfile is not registers:
+        registers.update(regfile)
+    if profile is not None:
+        print(profile.report())
     return registers
 
 EXAMPLE_CMD = """
@@ -71,6 +222,44 @@ def test_parser():
     r = parse(EXAMPLE_CMD.splitlines(), Registers.fromkeys("abcd", 0))
     assert r['a'] == 42
     
+def test_compile_command():
+    """Test compiling single commands."""
+    r = RegisterFile.fromkeys("abcd", 0)
+    assert compile_command("cpy 41 a", 3, r)() == 4
+    assert r['a'] == 41
+    assert compile_command("cpy a b", 0, r)() == 1
+    assert r['b'] == 41
+    assert compile_command("jnz b -2", 5, r)() == 3
+    assert compile_command("jnz 0 -2", 5, r)() == 6
+    with pytest.raises(ValueError):
+        compile_command("foo a", 0, r)
+    
+def test_register_file():
+    """Test the register file mapping view."""
+    r = RegisterFile.from_mapping(Registers.fromkeys("abcd", 0))
+    r['c'] = 1
+    assert r.slots == [0, 0, 1, 0]
+    assert dict(r) == {'a': 0, 'b': 0, 'c': 1, 'd': 0}
+    assert 'a' in r and '1' not in r
+    with pytest.raises(KeyError):
+        r['e'] = 1
+    r = parse(EXAMPLE_CMD.splitlines(), RegisterFile.fromkeys("abcd", 0))
+    assert r['a'] == 42
+    
+def test_profile():
+    """Test profiling the example."""
+    profile = Profile()
+    r = parse(EXAMPLE_CMD.splitlines(), Registers.fromkeys("abcd", 0), profile=profile)
+    assert r['a'] == 42
+    assert sum(profile.counts.values()) == 6
+    assert profile.calls["jnz"] == 2
+    assert not profile.back_edges
+    
+    profile = Profile()
+    parse(["cpy 3 b", "inc a", "dec b", "jnz b -2"], RegisterFile.fromkeys("abcd", 0), profile=profile)
+    assert profile.back_edges == {(3, 1): 2}
+    assert "[inc a; dec b; jnz b -2]" in profile.report()
+    
 PUZZLE_CMD = """
 cpy 1 a
 cpy 1 b
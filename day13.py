@@ -2,6 +2,11 @@
 import collections
 import pytest
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 def binary_ones(num):
     """ones"""
     return bin(num)[2:].count('1')
@@ -17,6 +22,98 @@ def is_wall(x, y, special):
 def test_is_wall(x, y, special, result):
     assert is_wall(x, y, special) == result
 
+def walls(width, height, special, x0=0, y0=0):
+    """Wall status for a block of cells from (x0, y0), as row-major bytes.
+    
+    With numpy, the popcount parity is computed for the whole block by
+    folding each value onto its lowest bit.
+    """
+    if np is None:
+        return bytes(is_wall(x, y, special) for y in range(y0, y0 + height) for x in range(x0, x0 + width))
+    y, x = np.mgrid[y0:y0 + height, x0:x0 + width].astype(np.int64)
+    n = x*x + 3*x + 2*x*y + y + y*y + special
+    for shift in (32, 16, 8, 4, 2, 1):
+        n ^= n >> shift
+    return (n & 1).astype(np.uint8).tobytes()
+    
+class Maze(object):
+    """The office maze for a magic number, with walls computed in bulk.
+    
+    Walls are stored as a row of bytes, one per cell, for each row within
+    width and height. When a lookup falls outside, only the axis it overflows
+    doubles, and only the new strip of cells is computed.
+    """
+    def __init__(self, special, width=64, height=64):
+        super(Maze, self).__init__()
+        self.special = special
+        self.width = 0
+        self.height = 0
+        self.rows = []
+        self.grow(width, height)
+        
+    def __repr__(self):
+        return f"<Maze {self.special:d} with {self.width:d}x{self.height:d} cells>"
+        
+    def grow(self, width, height):
+        """Compute walls for a region at least width by height."""
+        if width > self.width:
+            extra = width - self.width
+            strip = walls(extra, self.height, self.special, x0=self.width)
+            for y, row in enumerate(self.rows):
+                row += strip[y * extra:(y + 1) * extra]
+            self.width = width
+        if height > self.height:
+            block = walls(self.width, height - self.height, self.special, y0=self.height)
+            self.rows.extend(bytearray(block[i:i + self.width]) for i in range(0, len(block), self.width))
+            self.height = height
+        
+    def is_wall(self, x, y):
+        """Is this a wall?"""
+        if x < 0 or y < 0:
+            return True
+        if x >= self.width:
+            self.grow(max(2 * self.width, x + 1), self.height)
+        if y >= self.height:
+            self.grow(self.width, max(2 * self.height, y + 1))
+        return self.rows[y][x] == 1
+        
+    def open_moves(self, x, y):
+        """Yield only available moves."""
+        for nx, ny in moves(x, y):
+            if not self.is_wall(nx, ny):
+                yield (nx, ny)
+    
+@pytest.fixture(params=[True, False], ids=["numpy", "python"])
+def use_numpy(request, monkeypatch):
+    """Run with and without numpy."""
+    if request.param and np is None:
+        pytest.skip("numpy is not installed")
+    if not request.param:
+        monkeypatch.setitem(globals(), "np", None)
+    return request.param
+    
+def test_maze(use_numpy):
+    """Test the maze against is_wall, as it grows."""
+    maze = Maze(1362, 4, 4)
+    assert maze.is_wall(-1, 0)
+    for x, y in [(0, 0), (3, 3), (10, 2), (1, 40), (90, 90)]:
+        assert maze.is_wall(x, y) == is_wall(x, y, 1362)
+    assert maze.width >= 91 and maze.height >= 91
+    assert b"".join(maze.rows) == walls(maze.width, maze.height, 1362)
+    assert all(maze.is_wall(x, y) == is_wall(x, y, 1362) for x in range(91) for y in range(91))
+    
+def test_maze_corridor(use_numpy):
+    """Test that probing along one axis only grows that axis."""
+    maze = Maze(1362, 4, 4)
+    assert maze.is_wall(1600, 0) == is_wall(1600, 0, 1362)
+    assert (maze.width, maze.height) == (1601, 4)
+    assert maze.is_wall(3, 200) == is_wall(3, 200, 1362)
+    assert (maze.width, maze.height) == (1601, 201)
+    assert maze.is_wall(1600, 200) == is_wall(1600, 200, 1362)
+    assert maze.is_wall(1601, 5) == is_wall(1601, 5, 1362)
+    assert (maze.width, maze.height) == (3202, 201)
+    assert walls(3, 2, 1362, x0=5, y0=7) == bytes(maze.is_wall(x, y) for y in range(7, 9) for x in range(5, 8))
+
 def moves(x, y):
     """Possible moves from x, y"""
     if x > 0:
@@ -26,57 +123,118 @@ def moves(x, y):
     yield (x + 1, y)
     yield (x, y + 1)
     
-def open_moves(x, y, special):
-    """Yield only available moves."""
-    for nx, ny in moves(x, y):
-        if not is_wall(nx, ny, special):
-            yield (nx, ny)
-        
+class DistanceField(object):
+    """Distances from a start cell through a :class:`Maze`.
     
-def forward_moves(x, y, special, path):
-    """Prevent backtracking."""
-    for nx, ny in open_moves(x, y, special):
-        if (nx, ny) not in path:
-            yield (nx, ny)
+    This is a single breadth first search, which only goes as far as
+    queries need and resumes from where it stopped for later queries.
+    """
+    def __init__(self, maze, start=(1,1)):
+        super(DistanceField, self).__init__()
+        self.maze = maze
+        self.start = start
+        self.distances = {start: 0}
+        self.predecessors = {start: None}
+        self.to_check = collections.deque([start])
+        
+    def __repr__(self):
+        return f"<DistanceField from {self.start} with {len(self.distances):,d} cells>"
+        
+    def _expand(self):
+        """Expand the next cell in the search."""
+        position = self.to_check.popleft()
+        d = self.distances[position] + 1
+        for move in self.maze.open_moves(*position):
+            if move not in self.distances:
+                self.distances[move] = d
+                self.predecessors[move] = position
+                self.to_check.append(move)
         
+    def distance(self, x, y):
+        """Distance to a cell, or None if it can't be reached."""
+        while (x, y) not in self.distances and self.to_check:
+            self._expand()
+        return self.distances.get((x, y))
+        
+    def path(self, x, y):
+        """A shortest path to a cell, or None if it can't be reached."""
+        if self.distance(x, y) is None:
+            return None
+        return trace(self.predecessors, (x, y))
+        
+    def reachable_within(self, k):
+        """Map each cell within k steps to its distance."""
+        while self.to_check and self.distances[self.to_check[0]] < k:
+            self._expand()
+        return { position:d for position, d in self.distances.items() if d <= k }
+    
+DISTANCE_FIELDS = {}
+MAZES = {}
+def distance_field(special, start=(1,1)):
+    """The cached distance field for a magic number and start."""
+    key = (special, start)
+    if key not in DISTANCE_FIELDS:
+        if special not in MAZES:
+            MAZES[special] = Maze(special)
+        DISTANCE_FIELDS[key] = DistanceField(MAZES[special], start)
+    return DISTANCE_FIELDS[key]
+    
+def trace(predecessors, target):
+    """Trace a path back to the start through a map of predecessors."""
+    path = []
+    while target is not None:
+        path.append(target)
+        target = predecessors[target]
+    return path[::-1]
     
 def walk(special, target, start=(1,1)):
     """Walk an area searching for a target."""
-    paths = {start:[start]}
-    to_check = collections.deque([start])
-    while len(to_check):
-        position = to_check.popleft()
-        path = paths[position]
-        for move in forward_moves(*position, special, path):
-            if move not in path:
-                paths[move] = path + [move]
-                to_check.append(move)
-            elif len(paths[move]) > len(path) + 1:
-                paths[move] = path + [move]
-        if target in paths:
-            return paths[target]
-        
+    return distance_field(special, start).path(*target)
     
 def explore(special, distance, start=(1,1)):
-    """Explore"""
-    paths = {start:[start]}
-    to_check = collections.deque([start])
-    while len(to_check):
-        position = to_check.popleft()
-        path = paths[position]
-        if len(path) > distance:
-            continue
-        for move in forward_moves(*position, special, path):
-            if move not in path:
-                paths[move] = path + [move]
-                to_check.append(move)
-            elif len(paths[move]) > len(path) + 1:
-                paths[move] = path + [move]
-    return paths
+    """Explore, returning the distance to each cell within reach."""
+    return distance_field(special, start).reachable_within(distance)
     
 def test_example():
     """Test the example"""
-    assert len(walk(10, (7, 4))) - 1 == 11
+    path = walk(10, (7, 4))
+    assert len(path) - 1 == 11
+    assert path[0] == (1, 1)
+    assert path[-1] == (7, 4)
+    for (x0, y0), (x1, y1) in zip(path[:-1], path[1:]):
+        assert abs(x1 - x0) + abs(y1 - y0) == 1
+        assert not is_wall(x1, y1, 10)
+    
+def test_explore():
+    """Test exploring a limited distance."""
+    reachable = explore(10, 2)
+    assert reachable == {(1, 1): 0, (0, 1): 1, (1, 2): 1, (0, 0): 2, (2, 2): 2}
+    assert max(explore(1362, 50).values()) == 50
+    
+def test_distance_field():
+    """Test the cached distance field."""
+    field = distance_field(10)
+    assert distance_field(10, (1, 1)) is field
+    assert distance_field(10, (7, 4)) is not field
+    assert distance_field(10, (7, 4)).maze is field.maze
+    assert field.distance(7, 4) == 11
+    assert field.distance(1, 1) == 0
+    assert field.distance(1, 0) is None
+    assert field.reachable_within(2) == explore(10, 2)
+    assert distance_field(10, (7, 4)).distance(1, 1) == 11
+    
+    field = DistanceField(Maze(1362))
+    assert len(field.reachable_within(50)) == 138
+    assert field.distance(31, 39) == 82
+    
+def test_walk_far():
+    """Test walking to the furthest reachable cell."""
+    reachable = explore(1362, 1000)
+    target = max(reachable, key=reachable.get)
+    path = walk(1362, target)
+    assert len(path) - 1 == reachable[target] == 146
+    assert len(path) == len(set(path))
+    assert walk(1362, (101, 101)) is None
     
 def puzzle1():
     """First puzzle."""
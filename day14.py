@@ -6,6 +6,10 @@ import itertools
 import collections
 import pytest
 import heapq
+import array
+import concurrent.futures
+import os
+import mmap
 
 TRIPLE = re.compile(r"(\w)\1\1")
 FIVES = re.compile(r"(\w)\1\1\1\1")
@@ -86,44 +90,386 @@ def test_find_fives(index, pattern):
     """Test finding five patterns."""
     assert pattern in set(iter_fives(gen_hash("abc", index)))
 
-def enum_hashes(salt, stretch=0):
-    """docstring for enum_hashes"""
-    hbase = hashlib.md5(salt.encode('ascii'))
-    for i in itertools.count():
-        yield i, _gen_hash(hbase, i, stretch=stretch)
+# Decimal suffixes for the last two digits of an index.
+SMALL_SUFFIXES = [ f"{i:d}".encode('ascii') for i in range(100) ]
+SUFFIXES = [ f"{i:02d}".encode('ascii') for i in range(100) ]
+
+def iter_prefixes(base, start=0, stop=None):
+    """Iterate through hashes for blocks of up to 100 consecutive indices.
     
-def test_enum_hashes():
-    """Test enumerate hashes."""
-    for i, digest in itertools.islice(enum_hashes("abc"), 19):
-        pass
-    assert "cc38887a5" in digest
+    Yields (first index, hash, suffixes), where the hash has been updated
+    with all but the last two digits of the indices in the block.
+    """
+    for p in itertools.count(start // 100):
+        lo = max(start - p * 100, 0)
+        hi = 100 if stop is None else min(stop - p * 100, 100)
+        if hi <= lo:
+            return
+        if p:
+            h = base.copy()
+            h.update(f"{p:d}".encode('ascii'))
+            yield p * 100 + lo, h, SUFFIXES[lo:hi]
+        else:
+            yield lo, base, SMALL_SUFFIXES[lo:hi]
+
+def stretch_digest(h, n):
+    """Stretch an md5 hash n times, returning the raw digest."""
+    for i in range(n):
+        h = hashlib.md5(h.hexdigest().encode('ascii'))
+    return h.digest()
+    
+# Masks over the 31 adjacent nibble pairs of a 128-bit digest.
+NIBBLE_ONES = int("1" * 31, 16)
 
+def digest_features(digest):
+    """Find the first triple digit (or None) and a bitmask of the five-run digits in a raw digest.
+    
+    Nibbles are compared all at once: after ``x ^ (x >> 4)``, a zero nibble
+    marks a nibble equal to its neighbour, and runs of those mark triples
+    and fives. The most significant match comes first in the hex digest.
+    """
+    x = int.from_bytes(digest, "big")
+    y = x ^ (x >> 4)
+    equal = NIBBLE_ONES & ~(y | (y >> 1) | (y >> 2) | (y >> 3))
+    triples = equal & (equal >> 4)
+    if not triples:
+        return None, 0
+    position = triples.bit_length() - 1
+    triple = (x >> position) & 0xF
+    fives = 0
+    runs = triples & (triples >> 8)
+    while runs:
+        position = runs.bit_length() - 1
+        fives |= 1 << ((x >> position) & 0xF)
+        runs ^= 1 << position
+    return triple, fives
+    
+def iter_bits(mask):
+    """Iterate through the set bits of a mask."""
+    while mask:
+        bit = mask & -mask
+        yield bit.bit_length() - 1
+        mask ^= bit
+    
+NO_TRIPLE = 0xFF
+class HashRows(object):
+    """Stretched digests and their features for one salt and stretch.
+    
+    Rows are stored compactly: 16 raw bytes per digest, a byte for the
+    first triple digit, and a 16 bit mask of five-run digits.
+    """
+    ROW_BYTES = 16 + 1 + 2
+    
+    def __init__(self):
+        super(HashRows, self).__init__()
+        self.digests = bytearray()
+        self.triples = bytearray()
+        self.fives = array.array('H')
+        
+    def __len__(self):
+        return len(self.triples)
+        
+    def __getitem__(self, index):
+        triple = self.triples[index]
+        return bytes(self.digests[16 * index:16 * (index + 1)]), (None if triple == NO_TRIPLE else triple), self.fives[index]
+        
+    @property
+    def nbytes(self):
+        """Size of the rows in bytes."""
+        return len(self) * self.ROW_BYTES
+        
+    def append(self, digest, triple, fives):
+        """Append a row."""
+        self.digests.extend(digest)
+        self.triples.append(NO_TRIPLE if triple is None else triple)
+        self.fives.append(fives)
+    
+class HashCache(object):
+    """An in-process cache of stretched digests, by salt and stretch.
+    
+    When the total size would pass max_bytes, the least recently used
+    salts are evicted. A single salt is never grown past max_bytes.
+    """
+    def __init__(self, max_bytes=64 * 2**20):
+        super(HashCache, self).__init__()
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.entries = collections.OrderedDict()
+        
+    def __repr__(self):
+        return f"<HashCache with {len(self.entries):d} salts, {self.nbytes:,d} bytes>"
+        
+    def rows(self, salt, stretch):
+        """The cached rows for a salt and stretch, marking them as recently used."""
+        key = (salt, stretch)
+        if key not in self.entries:
+            self.entries[key] = HashRows()
+        self.entries.move_to_end(key)
+        return self.entries[key]
+        
+    def add(self, salt, stretch, index, digest, triple, fives):
+        """Add the row at index, if it is the next one for a cached salt."""
+        rows = self.entries.get((salt, stretch))
+        if rows is None or index != len(rows):
+            return False
+        while self.nbytes + HashRows.ROW_BYTES > self.max_bytes:
+            key = next(iter(self.entries))
+            if key == (salt, stretch):
+                return False
+            self.nbytes -= self.entries.pop(key).nbytes
+        rows.append(digest, triple, fives)
+        self.nbytes += HashRows.ROW_BYTES
+        return True
+        
+HASH_CACHE = HashCache()
 
-def iter_keys(salt, stretch=0, verbose=False):
+def iter_rows(salt, stretch=0, start=0, stop=None):
+    """Iterate through (index, digest, triple, fives) rows from start."""
+    hbase = hashlib.md5(salt.encode('ascii'))
+    for first, prefix, suffixes in iter_prefixes(hbase, start, stop):
+        for offset, suffix in enumerate(suffixes):
+            h = prefix.copy()
+            h.update(suffix)
+            digest = stretch_digest(h, stretch)
+            yield (first + offset, digest) + digest_features(digest)
+            
+def hash_block(salt, stretch, start, stop):
+    """Compute the rows for a block of indices."""
+    return list(iter_rows(salt, stretch, start, stop))
+    
+def test_iter_rows():
+    """Test enumerating rows from index prefixes."""
+    rows = list(itertools.islice(iter_rows("abc"), 1234))
+    assert "cc38887a5" in rows[18][1].hex()
+    for i, digest, triple, fives in rows:
+        assert digest.hex() == gen_hash("abc", i)
+    assert list(iter_rows("abc", start=95, stop=105)) == rows[95:105]
+    
+def iter_rows_parallel(salt, stretch=0, start=0, processes=None, blocksize=1000):
+    """Iterate through rows, hashing blocks ahead of the consumer in a process pool.
+    
+    Blocks are submitted in order and consumed in order, so the rows match
+    :func:`iter_rows`.
+    """
+    processes = processes or os.cpu_count()
+    pool = concurrent.futures.ProcessPoolExecutor(processes)
+    try:
+        starts = itertools.count(start, blocksize)
+        pending = collections.deque()
+        for block in itertools.islice(starts, 2 * processes):
+            pending.append(pool.submit(hash_block, salt, stretch, block, block + blocksize))
+        while True:
+            rows = pending.popleft().result()
+            block = next(starts)
+            pending.append(pool.submit(hash_block, salt, stretch, block, block + blocksize))
+            yield from rows
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+    
+class HashStore(object):
+    """A persistent store of raw stretched digests, by salt and stretch.
+    
+    Each salt and stretch has a file in directory holding 16 bytes per
+    index, in order, which is read through a memory map. Files are only
+    appended to, so a store shouldn't be written by two processes at once.
+    """
+    def __init__(self, directory):
+        super(HashStore, self).__init__()
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        
+    def __repr__(self):
+        return f"<HashStore {self.directory!r}>"
+        
+    def path(self, salt, stretch):
+        """The file for a salt and stretch."""
+        return os.path.join(self.directory, f"{salt.encode('utf-8').hex()}-{stretch:d}.md5")
+        
+    def count(self, salt, stretch):
+        """The number of stored digests."""
+        try:
+            return os.path.getsize(self.path(salt, stretch)) // 16
+        except FileNotFoundError:
+            return 0
+        
+    def read(self, salt, stretch, start=0):
+        """Iterate through (index, digest) pairs from start."""
+        n = self.count(salt, stretch)
+        if n <= start:
+            return
+        with open(self.path(salt, stretch), "rb") as f:
+            with mmap.mmap(f.fileno(), n * 16, access=mmap.ACCESS_READ) as m:
+                for index in range(start, n):
+                    yield index, m[16 * index:16 * (index + 1)]
+                    
+    def writer(self, salt, stretch):
+        """Open a writer which appends digests."""
+        return HashStoreWriter(self.path(salt, stretch))
+        
+class HashStoreWriter(object):
+    """Append digests to a :class:`HashStore` file, in index order.
+    
+    Writes are unbuffered, and the file size is checked before each one,
+    so several writers for the same file never store an index twice.
+    """
+    def __init__(self, path):
+        super(HashStoreWriter, self).__init__()
+        self.file = open(path, "ab", buffering=0)
+        # Drop any partially written digest.
+        self.file.truncate(self.count * 16)
+        
+    @property
+    def count(self):
+        """The number of digests in the file."""
+        return os.fstat(self.file.fileno()).st_size // 16
+        
+    def write(self, index, digest):
+        """Write the digest for index, if it is the next one."""
+        if index == self.count:
+            self.file.write(digest)
+            
+    def close(self):
+        """Close the file."""
+        self.file.close()
+    
+def enum_features(salt, stretch=0, cache=HASH_CACHE, processes=1, store=None):
+    """Enumerate (index, digest, triple, fives) for each index.
+    
+    The digest is raw, triple is the digit of the first triple or None,
+    and fives is a bitmask of the digits which appear five in a row.
+    Rows already in the cache are replayed, and new rows are added to it.
+    Then, with a :class:`HashStore`, stored digests are read, and new ones
+    are saved. With more than one process (or None, for one per CPU), new
+    rows are hashed by :func:`iter_rows_parallel`.
+    """
+    rows = cache.rows(salt, stretch) if cache is not None else HashRows()
+    i = 0
+    while i < len(rows):
+        yield (i,) + rows[i]
+        i += 1
+        
+    writer = store.writer(salt, stretch) if store is not None else None
+    try:
+        if writer is not None:
+            # Store anything only in the cache, then read past the cache.
+            for index in range(writer.count, i):
+                writer.write(index, rows[index][0])
+            for index, digest in store.read(salt, stretch, i):
+                row = (index, digest) + digest_features(digest)
+                if cache is not None:
+                    cache.add(salt, stretch, *row)
+                yield row
+                i = index + 1
+            
+        if processes != 1:
+            new_rows = iter_rows_parallel(salt, stretch, i, processes=processes)
+        else:
+            new_rows = iter_rows(salt, stretch, i)
+        try:
+            for row in new_rows:
+                if cache is not None:
+                    cache.add(salt, stretch, *row)
+                if writer is not None:
+                    writer.write(row[0], row[1])
+                yield row
+        finally:
+            new_rows.close()
+    finally:
+        if writer is not None:
+            writer.close()
+    
+def test_hash_store(tmp_path, monkeypatch):
+    """Test storing and reading digests."""
+    store = HashStore(str(tmp_path))
+    cache = HashCache()
+    rows = list(itertools.islice(enum_features("abc", 16, cache=cache), 20))
+    assert list(itertools.islice(enum_features("abc", 16, cache=cache, store=store), 30)) == list(itertools.islice(enum_features("abc", 16, cache=None), 30))
+    assert store.count("abc", 16) == 30
+    assert store.count("abc", 0) == 0
+    
+    # Two iterators appending to the same file at once.
+    first = enum_features("abc", 16, cache=None, store=store)
+    second = enum_features("abc", 16, cache=None, store=store)
+    both = [ (next(first), next(second)) for i in range(40) ]
+    first.close()
+    second.close()
+    assert all(a == b for a, b in both)
+    assert store.count("abc", 16) == 40
+    
+    def fail(h, n):
+        raise AssertionError("Should be read from the store.")
+    monkeypatch.setattr(__import__(__name__), "stretch_digest", fail)
+    stored = list(itertools.islice(enum_features("abc", 16, cache=None, store=HashStore(str(tmp_path))), 40))
+    assert stored[:20] == rows
+    assert [ digest.hex() for i, digest, triple, fives in stored ] == [ gen_hash("abc", i, 16) for i in range(40) ]
+    
+def test_hash_cache():
+    """Test caching and evicting rows."""
+    cache = HashCache(max_bytes=HashRows.ROW_BYTES * 150)
+    features = list(itertools.islice(enum_features("abc", cache=cache), 100))
+    assert len(cache.rows("abc", 0)) == 100
+    assert features[39][1].hex() == gen_hash("abc", 39)
+    assert features[39][2] == 0xe
+    assert list(itertools.islice(enum_features("abc", cache=cache), 120)) == list(itertools.islice(enum_features("abc", cache=None), 120))
+    assert len(cache.rows("abc", 0)) == 120
+    list(itertools.islice(enum_features("abd", cache=cache), 100))
+    assert list(cache.entries) == [("abd", 0)]
+    assert cache.nbytes == 100 * HashRows.ROW_BYTES
+    list(itertools.islice(enum_features("abd", cache=cache), 200))
+    assert len(cache.rows("abd", 0)) == 150
+    
+@pytest.mark.parametrize("digest, triple, fives",[
+    ("cc38887a5" + "12" * 11 + "3", 8, 0),
+    ("abeee00000cd" + "9" * 20, 0xe, 0b1000000001),
+    ("12" * 16, None, 0),
+    ("111" + "23" * 14 + "4", 1, 0),
+    ("4" + "23" * 14 + "fff", 0xf, 0),
+    ("fffff" + "23" * 11 + "00000", 0xf, 0b1000000000000001),
+    ("7" * 32, 7, 0b10000000),
+])
+def test_digest_features(digest, triple, fives):
+    """Test finding features of a raw digest."""
+    assert digest_features(bytes.fromhex(digest)) == (triple, fives)
+    
+def test_digest_features_regex():
+    """Test finding features against the regular expressions."""
+    for i in range(2000):
+        digest = hashlib.md5(f"{i:d}".encode('ascii')).digest()
+        hexdigest = digest.hex()
+        m = TRIPLE.search(hexdigest)
+        fives = 0
+        for match in iter_fives(hexdigest):
+            fives |= 1 << int(match, 16)
+        assert digest_features(digest) == ((int(m.group(1), 16) if m else None), fives)
+    
+def iter_keys(salt, stretch=0, verbose=False, cache=HASH_CACHE, processes=1, store=None):
     """Iterate through keys."""
-    candidates = collections.defaultdict(list)
+    # Candidate triples for each digit, in index order.
+    candidates = collections.defaultdict(collections.deque)
     keys = []
-    for i, digest in enum_hashes(salt, stretch=stretch):
-        for match in iter_triples(digest):
-            candidates[match].append((i, digest))
-        for match in iter_fives(digest):
-            if match in candidates:
-                triples = candidates[match]
-                for index, key in triples[:]:
-                    if (index + 1000) >= i > index:
-                        heapq.heappush(keys, (index, key, i, digest))
-                        triples.remove((index, key))
-                    elif (index + 1000) <= i:
-                        triples.remove((index, key))
+    for i, digest, triple, fives in enum_features(salt, stretch=stretch, cache=cache, processes=processes, store=store):
+        for match in iter_bits(fives):
+            triples = candidates.get(match)
+            while triples:
+                index, key = triples.popleft()
+                if index + 1000 >= i:
+                    heapq.heappush(keys, (index, key.hex(), i, digest.hex()))
+        if triple is not None:
+            triples = candidates[triple]
+            while triples and triples[0][0] + 1000 < i:
+                triples.popleft()
+            triples.append((i, digest))
         while len(keys) and keys[0][0] + 1000 <= i:
             yield heapq.heappop(keys)
         if verbose and i % 10000 == 0:
             print(f"Index {i:,d}, N={len(candidates)}")
 
-def keygen(salt, keys, stretch=0):
+def keygen(salt, keys, stretch=0, cache=HASH_CACHE, processes=1, store=None):
     """Generate a set number of keys."""
-    for index, key, vindex, vdigest in itertools.islice(iter_keys(salt, stretch=stretch), keys):
+    key_iter = iter_keys(salt, stretch=stretch, cache=cache, processes=processes, store=store)
+    for index, key, vindex, vdigest in itertools.islice(key_iter, keys):
         yield index, key
+    key_iter.close()
 
 def test_find_first_key():
     """Test the example salt."""
@@ -157,6 +503,11 @@ def test_find_first_key_streched():
     assert i == 10
     assert "eee" in key
     
+def test_parallel_rows():
+    """Test hashing rows in parallel."""
+    rows = list(itertools.islice(iter_rows_parallel("abc", 2016, processes=2, blocksize=50), 120))
+    assert rows == list(itertools.islice(iter_rows("abc", 2016), 120))
+    
 def test_example_salt_streched():
     keys = []
     for i, key, vindex, vdigest in itertools.islice(iter_keys("abc", stretch=2016), 64):
@@ -179,7 +530,7 @@ def puzzle1():
 def puzzle2():
     """Second puzzle"""
     print("Puzzle #2")
-    for n, (i, key) in enumerate(keygen(SALT, 64, stretch=2016)):
+    for n, (i, key) in enumerate(keygen(SALT, 64, stretch=2016, processes=None, store=HashStore("day14_store"))):
         print(f"Key {n:d} is at index {i:d} and is {key:s}")
     print(f"index {i:,d} produces the 64th key.")
     
@@ -3,6 +3,8 @@
 import pytest
 import re
 import itertools
+import math
+import io
 
 def is_open(time, index, offset, size):
     """Check if the disk is open."""
@@ -30,12 +32,120 @@ def parse_disks(lines):
     for line in lines:
         yield parse_disk(line)
     
-def find_opening(disks):
-    """Find the first available opening."""
+def scan_opening(disks):
+    """Find the first available opening by checking every time."""
     for i in itertools.count():
         if all(is_open(i, *disk) for disk in disks):
             return i
     
+def combine(congruence, index, offset, size):
+    """Combine time = a (mod m) with the times at which a disk is open.
+    
+    Returns the combined (a, m), or None if the disk is never open at
+    those times. Sizes need not be coprime.
+    """
+    a, m = congruence
+    b = -(index + offset) % size
+    g = math.gcd(m, size)
+    if (b - a) % g:
+        return None
+    n = size // g
+    k = (b - a) // g * pow(m // g, -1, n) % n if n > 1 else 0
+    m *= n
+    return (a + m // n * k) % m, m
+    
+def solve(disks, congruence=(0, 1)):
+    """Find the congruence (a, m) for times at which all disks are open, or None."""
+    for disk in disks:
+        congruence = combine(congruence, *disk)
+        if congruence is None:
+            break
+    return congruence
+    
+def find_opening(disks):
+    """Find the first available opening."""
+    congruence = solve(disks)
+    if congruence is None:
+        raise ValueError("The disks are never all open.")
+    return congruence[0]
+    
+class PrefixSolver(object):
+    """Solve many disk configurations, reusing the congruences of shared prefixes.
+    
+    Solved prefixes are kept in a trie of ``{disk: (congruence, children)}``.
+    """
+    def __init__(self):
+        super(PrefixSolver, self).__init__()
+        self.root = ((0, 1), {})
+        
+    def solve(self, disks):
+        """Find the congruence (a, m) for times at which all disks are open, or None."""
+        congruence, children = self.root
+        for disk in disks:
+            if congruence is None:
+                break
+            node = children.get(disk)
+            if node is None:
+                node = children[disk] = (combine(congruence, *disk), {})
+            congruence, children = node
+        return congruence
+        
+    def find_opening(self, disks):
+        """Find the first available opening, or None."""
+        congruence = self.solve(disks)
+        return congruence[0] if congruence is not None else None
+    
+def iter_configurations(lines):
+    """Iterate through disk configurations, separated by blank lines."""
+    disks = []
+    for line in lines:
+        if line.strip():
+            disks.append(parse_disk(line.strip()))
+        elif disks:
+            yield disks
+            disks = []
+    if disks:
+        yield disks
+        
+def find_openings(configurations, solver=None):
+    """Find the first opening (or None) for each configuration."""
+    solver = solver if solver is not None else PrefixSolver()
+    for disks in configurations:
+        yield solver.find_opening(disks)
+        
+def solve_file(infile, outfile):
+    """Write the first opening for each configuration in infile to outfile, one per line."""
+    for opening in find_openings(iter_configurations(infile)):
+        outfile.write("never\n" if opening is None else f"{opening:d}\n")
+        outfile.flush()
+        
+@pytest.mark.parametrize("disks", [
+    [(1, 4, 5), (2, 1, 2)],
+    [(1, 0, 4), (2, 1, 6)],
+    [(1, 2, 6), (2, 3, 10), (3, 12, 15)],
+    [(1, 0, 1), (2, 0, 1)],
+    [(1, 3, 12), (2, 2, 18), (3, 1, 8)],
+])
+def test_find_opening(disks):
+    """Test solving congruences against scanning every time."""
+    assert find_opening(disks) == scan_opening(disks)
+    
+def test_never_open():
+    """Test disks which are never all open."""
+    disks = [(1, 0, 4), (2, 0, 6)]
+    assert solve(disks) is None
+    with pytest.raises(ValueError):
+        find_opening(disks)
+    
+def test_large_primes():
+    """Test many disks with large prime sizes."""
+    primes = [ 1000003, 1000033, 1000037, 1000039, 1000081, 1000099, 1000117, 1000121, 1000133, 1000151,
+               1000159, 1000171, 1000183, 1000187, 1000193, 1000199, 1000211, 1000213, 1000231, 1000249 ]
+    disks = [ (index, (index * 7919) % size, size) for index, size in enumerate(primes, 1) ]
+    time = find_opening(disks)
+    assert time < math.prod(primes)
+    assert all(is_open(time, *disk) for disk in disks)
+    
 
 EXAMPLE = """Disc #1 has 5 positions; at time=0, it is at position 4.
 Disc #2 has 2 positions; at time=0, it is at position 1."""
@@ -45,6 +155,18 @@ def test_example_q():
     opening = find_opening(disks)
     assert opening == 5
     
+def test_find_openings():
+    """Test solving many configurations from a file."""
+    solver = PrefixSolver()
+    assert list(find_openings([[(1, 4, 5)], [(1, 4, 5), (2, 1, 2)], [(1, 0, 4), (2, 0, 6)]], solver)) == [0, 5, None]
+    assert set(solver.root[1]) == {(1, 4, 5), (1, 0, 4)}
+    
+    infile = io.StringIO(EXAMPLE + "\n\n" + EXAMPLE + "\nDisc #3 has 3 positions; at time=0, it is at position 0.\n\n\n"
+                         "Disc #1 has 4 positions; at time=0, it is at position 0.\nDisc #2 has 6 positions; at time=0, it is at position 0.\n")
+    outfile = io.StringIO()
+    solve_file(infile, outfile)
+    assert outfile.getvalue().splitlines() == ["5", "15", "never"]
+    
 INPUT = """\
 Disc #1 has 13 positions; at time=0, it is at position 1.
 Disc #2 has 19 positions; at time=0, it is at position 10.
@@ -4,6 +4,11 @@ import pytest
 import string
 import itertools
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 trans = str.maketrans("01","10")
 
 def bitflipr(s):
@@ -58,15 +63,42 @@ def test_dragon(source, dragonified):
     """Test dragon curve"""
     assert "".join(dragon(source)) == dragonified
 
+FLIP = bytes.maketrans(b"01", b"10")
+
+def dragon_buffer(seed, length):
+    """Generate data up to a certain length as ASCII bytes.
+    
+    The buffer is grown by block doubling, appending "0" and then a
+    reversed, bit-flipped copy of itself, trimmed to what's needed.
+    """
+    data = bytearray(seed.encode('ascii'))
+    while len(data) < length:
+        n = len(data)
+        need = min(n, length - n - 1)
+        data += b"0"
+        data += data[n - need:n].translate(FLIP)[::-1]
+    del data[length:]
+    return data
+    
+@pytest.mark.parametrize("seed, length",[
+    ("1", 1),
+    ("10000", 20),
+    ("10000", 23),
+    ("01000100010010111", 272),
+    ("01000100010010111", 1000),
+])
+def test_dragon_buffer(seed, length):
+    """Test generating dragon data by block doubling."""
+    assert dragon_buffer(seed, length) == "".join(dragon_finite(seed, length)).encode('ascii')
+
 def dragon_data(seed, length):
     """Generate data up to a certain length."""
-    return "".join(dragon_finite(seed, length))
+    return dragon_buffer(seed, length).decode('ascii')
 
 def iterpairs(s):
     """Iterate through pairs"""
     iterator = iter(s)
-    while True:
-        yield next(iterator), next(iterator)
+    return zip(iterator, iterator)
         
 
 
@@ -121,6 +153,217 @@ def checksum_iterative(data, length):
     depth = checksum_depth(length)
     return checksum_recursive(data, depth)
     
+def checksum_chunk(length):
+    """The size of the chunk of data behind each checksum character.
+    
+    Each pass of the checksum is "1" for pairs with an even number of ones,
+    so after k passes a character is "1" for chunks of 2^k bits with an
+    even number of ones, where 2^k is the largest power of two in length.
+    """
+    chunk = length & -length
+    if chunk < 2:
+        raise ValueError(f"Can't checksum an odd length {length:d}")
+    return chunk
+    
+def checksum_parity(data, length):
+    """Checksum ASCII data from the parity of each chunk."""
+    chunk = checksum_chunk(length)
+    if np is None:
+        ones = [ data.count(b"1", start, start + chunk) for start in range(0, length, chunk) ]
+    else:
+        bits = np.frombuffer(data, dtype=np.uint8, count=length) & 1
+        ones = bits.reshape(-1, chunk).sum(axis=1, dtype=np.int64).tolist()
+    return "".join("0" if n % 2 else "1" for n in ones)
+    
+def separator_ones(n):
+    """Count the ones among the first n separators of dragon data.
+    
+    The k-th separator is "1" when the odd part of k is 3 (mod 4).
+    """
+    ones = 0
+    while n:
+        ones += (n + 1) // 4
+        n >>= 1
+    return ones
+    
+def dragon_ones(seed, n):
+    """Count the ones in the first n bits of dragon data, without generating it.
+    
+    Dragon data is the seed and its reversed, bit-flipped copy taking turns,
+    each followed by a separator.
+    """
+    size = len(seed)
+    prefix = [0] + list(itertools.accumulate(c == "1" for c in seed))
+    blocks, rest = divmod(n, size + 1)
+    ones = (blocks + 1) // 2 * prefix[size] + blocks // 2 * (size - prefix[size]) + separator_ones(blocks)
+    if blocks % 2:
+        # The reversed, flipped copy starts with the flipped end of the seed.
+        return ones + rest - (prefix[size] - prefix[size - rest])
+    return ones + prefix[rest]
+    
+def iter_checksum_dragon(seed, length):
+    """Iterate through pieces of the checksum from the parity of each chunk, without generating data.
+    
+    The count of ones is carried from one chunk boundary to the next.
+    Separators between them are added one at a time for short steps, and
+    counted afresh with :func:`separator_ones` for long ones. Short chunks
+    are quicker to fold from streamed data, with :func:`iter_checksum`.
+    """
+    chunk = checksum_chunk(length)
+    if chunk <= FOLD_CHUNK:
+        yield from iter_checksum(iter_dragon(seed, length), length)
+        return
+    size = len(seed)
+    prefix = [0] + list(itertools.accumulate(c == "1" for c in seed))
+    total = prefix[size]
+    blocks = separators = previous = 0
+    for end in range(chunk, length + 1, chunk):
+        target, rest = divmod(end, size + 1)
+        if target - blocks > 64:
+            separators = separator_ones(target)
+        else:
+            for k in range(blocks + 1, target + 1):
+                separators += (k // (k & -k)) >> 1 & 1
+        blocks = target
+        ones = (blocks + 1) // 2 * total + blocks // 2 * (size - total) + separators
+        if blocks % 2:
+            ones += rest - (total - prefix[size - rest])
+        else:
+            ones += prefix[rest]
+        yield "0" if (ones - previous) % 2 else "1"
+        previous = ones
+        
+def checksum_dragon(seed, length):
+    """Checksum dragon data from the parity of each chunk, without generating it."""
+    return "".join(iter_checksum_dragon(seed, length))
+    
+@pytest.fixture(params=[True, False], ids=["numpy", "python"])
+def use_numpy(request, monkeypatch):
+    """Run with and without numpy."""
+    if request.param and np is None:
+        pytest.skip("numpy is not installed")
+    if not request.param:
+        monkeypatch.setitem(globals(), "np", None)
+        
+@pytest.mark.parametrize("seed, length",[
+    ("10000", 20),
+    ("01000100010010111", 272),
+    ("110", 4096),
+    ("1", 10 * 1024),
+    ("10", 2 * 1001),
+    ("0110100", 1024 * 1023),
+    ("110", 4096 * 63),
+])
+def test_checksum_parity(seed, length, use_numpy):
+    """Test checksums from chunk parity."""
+    expected = "".join(checksum_iterative(dragon_data(seed, length), length))
+    assert checksum_parity(dragon_buffer(seed, length), length) == expected
+    assert checksum_dragon(seed, length) == expected
+    
+def test_dragon_ones():
+    """Test counting ones in dragon data."""
+    data = dragon_data("0110100", 1000)
+    assert [ dragon_ones("0110100", n) for n in range(1000) ] == [ data[:n].count("1") for n in range(1000) ]
+    
+def separator(k):
+    """The k-th separator (from 1) in dragon data."""
+    return b"1" if (k // (k & -k)) & 2 else b"0"
+    
+def iter_dragon(seed, length, size=65536):
+    """Iterate through dragon data up to length in ASCII pieces of about size bytes.
+    
+    Each piece holds a power of two number of blocks, each followed by its
+    separator. Separators repeat with that period, except for the middle
+    and last ones of a piece, so every piece is a copy of one template with
+    two separators filled in, and memory doesn't grow with length.
+    """
+    unit = len(seed) + 1
+    units = 2
+    while 2 * units * unit <= size:
+        units *= 2
+    pair = seed.encode('ascii') + b"0" + seed.encode('ascii').translate(FLIP)[::-1] + b"0"
+    template = bytearray(pair * (units // 2))
+    template[unit - 1::unit] = b"".join(separator(k) for k in range(1, units + 1))
+    k = 0
+    while length > 0:
+        piece = bytearray(template)
+        piece[units // 2 * unit - 1] = separator(k + units // 2)[0]
+        piece[units * unit - 1] = separator(k + units)[0]
+        del piece[length:]
+        length -= len(piece)
+        k += units
+        yield piece
+        
+BITS = bytes.maketrans(b"01", b"\x00\x01")
+PARITY = bytes.maketrans(b"\x00\x01", b"10")
+FOLD_CHUNK = 1024
+
+def chunk_parities(data, chunk):
+    """Checksum characters for ASCII data of whole chunks.
+    
+    The bits are folded together in one big integer: after folding by
+    1, 2, 4... bytes, the last byte of each chunk holds its parity.
+    """
+    x = int.from_bytes(data.translate(BITS), "big")
+    shift = 8
+    while shift < 8 * chunk:
+        x ^= x >> shift
+        shift *= 2
+    return x.to_bytes(len(data), "big")[chunk - 1::chunk].translate(PARITY).decode('ascii')
+    
+def iter_checksum(pieces, length):
+    """Iterate through pieces of the checksum, folding ASCII pieces of data into chunk parity.
+    
+    Chunks up to FOLD_CHUNK long are folded a whole piece at a time by
+    :func:`chunk_parities`, longer ones are counted a chunk at a time.
+    """
+    chunk = checksum_chunk(length)
+    if chunk <= FOLD_CHUNK:
+        pending = b""
+        for piece in pieces:
+            data = pending + piece
+            end = len(data) - len(data) % chunk
+            if end:
+                yield chunk_parities(data[:end], chunk)
+            pending = data[end:]
+        return
+    ones = 0
+    needed = chunk
+    for piece in pieces:
+        start = 0
+        while start < len(piece):
+            end = min(len(piece), start + needed)
+            ones += piece.count(b"1", start, end)
+            needed -= end - start
+            start = end
+            if not needed:
+                yield "0" if ones % 2 else "1"
+                ones = 0
+                needed = chunk
+                
+def checksum_stream(seed, length):
+    """Checksum dragon data as it is generated, in constant memory."""
+    return "".join(iter_checksum(iter_dragon(seed, length), length))
+    
+@pytest.mark.parametrize("seed, length, size",[
+    ("10000", 20, 1),
+    ("01000100010010111", 272, 50),
+    ("110", 4096, 100),
+    ("1", 10 * 1024, 7),
+    ("10", 2 * 1001, 64),
+    ("0110100", 1024 * 1023, 1000),
+    ("1", 1 << 14, 100),
+    ("110", 1 << 20, 65536),
+])
+def test_checksum_stream(seed, length, size):
+    """Test generating and checksumming dragon data in pieces."""
+    data = dragon_buffer(seed, length)
+    pieces = list(iter_dragon(seed, length, size))
+    assert b"".join(pieces) == data
+    assert max(len(piece) for piece in pieces) <= max(size, 2 * (len(seed) + 1))
+    assert "".join(iter_checksum(pieces, length)) == checksum_parity(data, length)
+    assert checksum_stream(seed, length) == checksum_parity(data, length)
+    
 def test_checksum():
     """Test the full algorithm."""
     assert checksum("110010110100") == "100"
@@ -146,7 +389,7 @@ def puzzle1():
 def puzzle2():
     print("Puzzle #2")
     length = 35651584
-    cs = "".join(checksum_iterative(dragon_data(INPUT, length), length))
+    cs = checksum_parity(dragon_buffer(INPUT, length), length)
     print(f"Checksum = {cs} ({len(cs)})")
     
 if __name__ == '__main__':
@@ -4,6 +4,9 @@ Day 12: Assembler
 """
 
 import collections
+import collections.abc
+import time
+import pytest
 
 class Registers(dict):
     """The assembly registers"""
@@ -32,79 +35,235 @@ class Registers(dict):
         """Decrement"""
         self[target] -= 1
         
-    def add(self, src, dest):
-        """Add to the target"""
-        self[dest] += self[src]
-        self[src] = 0
+
+class RegisterFile(collections.abc.MutableMapping):
+    """Registers stored in fixed integer slots.
+    
+    Compiled commands index into :attr:`slots` directly, while the
+    mapping interface (``r['a']``) is a thin view over those slots.
+    """
+    
+    def __init__(self, names):
+        super(RegisterFile, self).__init__()
+        self.names = tuple(names)
+        self.index = { name:i for i, name in enumerate(self.names) }
+        self.slots = [0] * len(self.names)
+    
+    @classmethod
+    def fromkeys(cls, names, value=0):
+        """Make a register file with each register set to value."""
+        r = cls(names)
+        r.slots[:] = [value] * len(r.names)
+        return r
         
-    def mul(self, mul, src, dest):
-        """Multiply target."""
-        self[dest] += (self[src] * self[mul])
-        self[src] = 0
-        self[mul] = 0
-    
-S_INC_DEC = set(["inc", "dec"])
-def optimize_add(command, commands, position):
-    """Optimize an addition command."""
-    if position + 3 > len(commands):
-        return command
-    
-    # Check for the correct pattern of next commands.
-    n3_cmds = [c[0] for c in commands[position:position+3]]
-    if n3_cmds[2] != "jnz":
-        return command
-    if set(n3_cmds[:2]) != S_INC_DEC:
-        return command
-    
-    # Check the jump argument
-    jnz_args = commands[position+2][1:]
-    if jnz_args[1] != "-2":
-        return command
-    
-    # locate the add arguments
-    predicate = jnz_args[0]
-    if n3_cmds[0] == "inc":
-        src = commands[position + 1][1]
-        dest = commands[position][1]
-    else:
-        src = commands[position][1]
-        dest = commands[position + 1][1]
-    
-    # Ensure the arguments make sense
-    if src == dest or src != predicate:
-        return command
-    
-    # Return optimized command
-    return "add", src, dest
-    
-def optimize_mul(command, commands, position):
-    """Optimize a multiplication loop."""
-    if command[0] != "add":
-        return command
-    if position + 5 > len(commands):
-        return command
-    n2_cmds = [c[0] for c in commands[position+3:position+5]]
-    if n2_cmds[1] != "jnz":
-        return command
-    if n2_cmds[0] != "dec":
-        return command
-    
-    # Check the jump argument
-    jnz_args = commands[position+4][1:]
-    if jnz_args[1] != "-5":
-        return command
-    mul = commands[position+3][1]
-    if mul in command[1:]:
-        return command
-    return "mul", mul, command[1], command[2]
+    @classmethod
+    def from_mapping(cls, mapping):
+        """Make a register file from an existing mapping of registers."""
+        r = cls(mapping.keys())
+        r.slots[:] = mapping.values()
+        return r
+    
+    def __repr__(self):
+        return repr(dict(self))
+    
+    def __getitem__(self, key):
+        return self.slots[self.index[key]]
+        
+    def __setitem__(self, key, value):
+        self.slots[self.index[key]] = value
+        
+    def __delitem__(self, key):
+        raise TypeError("Can't remove a register from a register file.")
+    
+    def __contains__(self, key):
+        return key in self.index
+        
+    def __iter__(self):
+        return iter(self.names)
+        
+    def __len__(self):
+        return len(self.names)
+    
+class Profile(object):
+    """An instruction level profile of a running program."""
+    def __init__(self):
+        super(Profile, self).__init__()
+        self.commands = {}
+        self.counts = collections.Counter()
+        self.calls = collections.Counter()
+        self.times = collections.Counter()
+        self.back_edges = collections.Counter()
+        
+    def wrap(self, position, command, opcode, op):
+        """Wrap a compiled command to record its execution."""
+        self.commands[position] = command
+        counts, calls, times, back_edges = self.counts, self.calls, self.times, self.back_edges
+        timer = time.perf_counter
+        def profiled():
+            start = timer()
+            nxt = op()
+            times[opcode] += timer() - start
+            calls[opcode] += 1
+            counts[position] += 1
+            if nxt <= position:
+                back_edges[(position, nxt)] += 1
+            return nxt
+        return profiled
+        
+    def report(self, top=10):
+        """Report on the profile."""
+        output = [f"Executed {sum(self.counts.values()):,d} instructions."]
+        output.append("Opcodes:")
+        for opcode, calls in self.calls.most_common():
+            t = self.times[opcode]
+            output.append(f"  {opcode:4s} {calls:15,d} calls {t:10.3f}s {t / calls * 1e9:8.1f}ns/call")
+        output.append("Hot instructions:")
+        for position, count in self.counts.most_common(top):
+            output.append(f"  {position:4d} {self.commands[position]:15s} {count:15,d}")
+        output.append("Hot loop back edges:")
+        for (back, head), count in self.back_edges.most_common(top):
+            body = "; ".join(self.commands.get(p, "?") for p in range(head, back + 1))
+            output.append(f"  {back:4d} -> {head:4d} {count:15,d} [{body}]")
+        return "\n".join(output)
+        
+def _poly_var(name):
+    """A polynomial which is just a register."""
+    return {(name,): 1}
+    
+def _poly_const(value):
+    """A constant polynomial."""
+    return {(): value} if value else {}
+    
+def _poly_add(p, q, scale=1):
+    """Add scale * q to p."""
+    result = dict(p)
+    for mono, coef in q.items():
+        coef = result.get(mono, 0) + scale * coef
+        if coef:
+            result[mono] = coef
+        else:
+            result.pop(mono, None)
+    return result
+    
+def _poly_mul(p, q):
+    """Multiply two polynomials."""
+    result = {}
+    for pm, pc in p.items():
+        for qm, qc in q.items():
+            result = _poly_add(result, {tuple(sorted(pm + qm)): pc * qc})
+    return result
+    
+def _poly_subs(p, values):
+    """Substitute register values (polynomials) into p."""
+    result = {}
+    for mono, coef in p.items():
+        term = _poly_const(coef)
+        for name in mono:
+            term = _poly_mul(term, values.get(name, _poly_var(name)))
+        result = _poly_add(result, term)
+    return result
+    
+def _poly_vars(p):
+    """The registers used by a polynomial."""
+    return { name for mono in p for name in mono }
 
-def optimizer(commands, position):
-    """A command optimizer."""
-    command = optimize_add(commands[position], commands, position)
-    command = optimize_mul(command, commands, position)
-    if command != commands[position]:
-        print(command)
-    return command
+def _back_edges(commands, head, end, names):
+    """Positions of counted-loop jumps back to head, last first."""
+    for position in range(end - 1, head, -1):
+        cmd, *args = commands[position]
+        if cmd == "jnz" and args[0] in names and args[1] not in names:
+            if position + int(args[1]) == head:
+                yield position
+    
+def summarize(commands, start, end, names):
+    """Summarize commands[start:end] as polynomials in the registers on entry.
+    
+    Returns (values, guards), where values maps each modified register to its
+    final value, and each guard must be positive for the summary to hold.
+    Only inc, dec, cpy and nested counted loops are understood, otherwise
+    this returns None.
+    """
+    values = {}
+    guards = []
+    position = start
+    while position < end:
+        back = next(_back_edges(commands, position, end, names), None)
+        if back is not None:
+            loop = summarize_loop(commands, position, back, names)
+            if loop is None:
+                return None
+            lvalues, lguards = loop
+            guards.extend(_poly_subs(g, values) for g in lguards)
+            values = dict(values, **{ reg:_poly_subs(p, values) for reg, p in lvalues.items() })
+            position = back + 1
+            continue
+        cmd, *args = commands[position]
+        if cmd in ("inc", "dec"):
+            target, = args
+            if target in names:
+                step = _poly_const(1 if cmd == "inc" else -1)
+                values[target] = _poly_add(values.get(target, _poly_var(target)), step)
+        elif cmd == "cpy":
+            src, dest = args
+            if dest in names:
+                if src in names:
+                    values[dest] = values.get(src, _poly_var(src))
+                else:
+                    values[dest] = _poly_const(int(src))
+        elif cmd == "jnz" and args[0] not in names and int(args[0]) == 0:
+            pass
+        else:
+            return None
+        position += 1
+    return values, guards
+    
+def summarize_loop(commands, head, back, names):
+    """Summarize a loop from head to the jnz at back in closed form.
+    
+    The loop counter must step by one towards zero each pass, and every other
+    register must either accumulate a loop-invariant amount or be assigned a
+    loop-invariant value. Returns (values, guards) like :func:`summarize`.
+    """
+    counter = commands[back][1]
+    body = summarize(commands, head, back, names)
+    if body is None:
+        return None
+    values, guards = body
+    modified = set(values)
+    if any(_poly_vars(g) & modified for g in guards):
+        return None
+    
+    step = _poly_add(values.get(counter, _poly_var(counter)), _poly_var(counter), -1)
+    if step == _poly_const(-1):
+        count = _poly_var(counter)
+    elif step == _poly_const(1):
+        count = _poly_mul(_poly_var(counter), _poly_const(-1))
+    else:
+        return None
+    
+    result = {counter: _poly_const(0)}
+    for reg, poly in values.items():
+        if reg == counter:
+            continue
+        delta = _poly_add(poly, _poly_var(reg), -1)
+        if not (_poly_vars(delta) & modified):
+            result[reg] = _poly_add(_poly_var(reg), _poly_mul(count, delta))
+        elif not (_poly_vars(poly) & modified):
+            result[reg] = poly
+        else:
+            return None
+    return result, guards + [count]
+    
+def optimize_loop(commands, head, names):
+    """Find a counted loop starting at head which can be run in closed form.
+    
+    Returns (back, values, guards) or None.
+    """
+    for back in _back_edges(commands, head, len(commands), names):
+        loop = summarize_loop(commands, head, back, names)
+        if loop is not None:
+            return (back,) + loop
+    return None
 
 def toggle(commands, target):
     """Toggle some command"""
@@ -125,40 +284,199 @@ def toggle(commands, target):
         else:
             commands[target] = ("jnz", *args)
 
-def parse(commands, registers):
-    """Parse commands"""
-    commands = [command.strip().split() for command in commands if command.strip()]
-    position = 0
-    n = 0
-    while position < len(commands):
-        command = optimizer(commands,position)
-        n += 1
-        cmd = command[0]
-        args = command[1:]
-        if cmd == "cpy":
-            registers.cpy(*args)
-        elif cmd == "inc":
-            registers.inc(*args)
-        elif cmd == "dec":
-            registers.dec(*args)
-        elif cmd == "jnz":
-            if registers.val(args[0]) != 0:
-                position += registers.val(args[1])
-                continue
-        elif cmd == "tgl":
-            target = registers.val(args[0]) + position
-            toggle(commands, target)
-        elif cmd == "add":
-            registers.add(*args)
-            position += 3
-            continue
-        elif cmd == "mul":
-            registers.mul(*args)
-            position += 5
-            continue
+def compile_command(command, position, program):
+    """Compile a single command into a closure.
+    
+    Operands are resolved once, here, into either a register slot or an
+    integer constant. The closure applies the command and returns the next
+    position to execute.
+    """
+    slots = program.registers.slots
+    index = program.registers.index
+    cmd = command[0]
+    args = command[1:]
+    nxt = position + 1
+    if cmd == "cpy":
+        src, dest = args
+        if dest not in index:
+            # Invalid after a toggle, skip it.
+            def op():
+                return nxt
+        elif src in index:
+            s, d = index[src], index[dest]
+            def op():
+                slots[d] = slots[s]
+                return nxt
         else:
-            raise ValueError(f"Can't parse command {command}")
-        position += 1
+            value, d = int(src), index[dest]
+            def op():
+                slots[d] = value
+                return nxt
+    elif cmd in ("inc", "dec"):
+        target, = args
+        step = 1 if cmd == "inc" else -1
+        if target not in index:
+            def op():
+                return nxt
+        else:
+            t = index[target]
+            def op():
+                slots[t] += step
+                return nxt
+    elif cmd == "jnz":
+        src, offset = args
+        if offset in index:
+            o = index[offset]
+            def jump():
+                return position + slots[o]
+        else:
+            target = position + int(offset)
+            def jump():
+                return target
+        if src in index:
+            s = index[src]
+            def op():
+                if slots[s] != 0:
+                    return jump()
+                return nxt
+        elif int(src) != 0:
+            op = jump
+        else:
+            def op():
+                return nxt
+    elif cmd == "tgl":
+        src, = args
+        if src in index:
+            s = index[src]
+            def op():
+                program.toggle(position + slots[s])
+                return nxt
+        else:
+            target = position + int(src)
+            def op():
+                program.toggle(target)
+                return nxt
+    else:
+        raise ValueError(f"Can't parse command {command}")
+    return op
+    
+def _compile_poly(poly, index):
+    """Compile a polynomial into (coefficient, slots) terms."""
+    return [ (coef, tuple(index[name] for name in mono)) for mono, coef in poly.items() ]
+    
+def _eval_poly(terms, slots):
+    """Evaluate a compiled polynomial."""
+    total = 0
+    for coef, mono in terms:
+        for i in mono:
+            coef *= slots[i]
+        total += coef
+    return total
+    
+def compile_loop(loop, fallback, program):
+    """Compile a loop summary into a closure.
+    
+    When any guard fails, the closure defers to the fallback closure for the
+    plain command at this position.
+    """
+    slots = program.registers.slots
+    index = program.registers.index
+    back, values, guards = loop
+    guards = [ _compile_poly(g, index) for g in guards ]
+    values = [ (index[reg], _compile_poly(p, index)) for reg, p in values.items() ]
+    nxt = back + 1
+    def op():
+        for g in guards:
+            if _eval_poly(g, slots) <= 0:
+                return fallback()
+        result = [ (i, _eval_poly(p, slots)) for i, p in values ]
+        for i, v in result:
+            slots[i] = v
+        return nxt
+    return op
+    
+class Program(object):
+    """A compiled program, which can be toggled while running.
+    
+    Registers should be a :class:`RegisterFile`. Each position holds a
+    compiled closure, optimized where a closed-form loop starts there.
+    Back edges are tracked so that a toggle only recompiles the loops
+    which contain the toggled command. If a :class:`Profile` is given,
+    each closure records its execution there.
+    """
+    def __init__(self, commands, registers, optimize=True, profile=None):
+        super(Program, self).__init__()
+        self.commands = [tuple(command.strip().split()) for command in commands if command.strip()]
+        self.registers = registers
+        self.optimize = optimize
+        self.profile = profile
+        self.compiled = [None] * len(self.commands)
+        self.edges = {}
+        for position in range(len(self.commands)):
+            self._index_edge(position)
+        for position in range(len(self.commands)):
+            self.recompile(position)
+            
+    def _index_edge(self, position):
+        """Record the loop head if the command at position is a back edge."""
+        self.edges.pop(position, None)
+        cmd, *args = self.commands[position]
+        index = self.registers.index
+        if cmd == "jnz" and args[0] in index and args[1] not in index:
+            head = position + int(args[1])
+            if 0 <= head < position:
+                self.edges[position] = head
+    
+    def _windows(self, target):
+        """Loop heads whose window includes target."""
+        return { head for back, head in self.edges.items() if head <= target <= back }
+        
+    def recompile(self, position):
+        """Compile the command at a position."""
+        command = self.commands[position]
+        op = compile_command(command, position, self)
+        opcode = command[0]
+        if self.optimize:
+            loop = optimize_loop(self.commands, position, self.registers.index)
+            if loop is not None:
+                op = compile_loop(loop, op, self)
+                opcode = "loop"
+        if self.profile is not None:
+            op = self.profile.wrap(position, " ".join(command), opcode, op)
+        self.compiled[position] = op
+    
+    def toggle(self, target):
+        """Toggle a command and recompile the affected loops."""
+        if not (0 <= target < len(self.commands)):
+            return
+        heads = self._windows(target)
+        toggle(self.commands, target)
+        self._index_edge(target)
+        heads.update(self._windows(target))
+        heads.add(target)
+        for head in heads:
+            self.recompile(head)
+    
+    def run(self):
+        """Run the program."""
+        compiled = self.compiled
+        position = 0
+        n = len(compiled)
+        while position < n:
+            position = compiled[position]()
+        return self.registers
+
+def parse(commands, registers, profile=None):
+    """Parse commands, printing a report if a profile is given."""
+    if isinstance(registers, RegisterFile):
+        regfile = registers
+    else:
+        regfile = RegisterFile.from_mapping(registers)
+    Program(commands, regfile, profile=profile).run()
+    if regfile is not registers:
+        registers.update(regfile)
+    if profile is not None:
+        print(profile.report())
     return registers
 
 EXAMPLE_CMD = """
@@ -176,6 +494,97 @@ def test_parser():
     r = parse(EXAMPLE_CMD.splitlines(), Registers.fromkeys("abcd", 0))
     assert r['a'] == 3
     
+def test_compile_command():
+    """Test compiling single commands."""
+    r = RegisterFile.fromkeys("abcd", 0)
+    program = Program(["cpy 1 a", "tgl a", "dec a"], r)
+    assert compile_command(("cpy", "4", "a"), 3, program)() == 4
+    assert r['a'] == 4
+    assert compile_command(("jnz", "1", "a"), 3, program)() == 7
+    assert compile_command(("cpy", "1", "2"), 3, program)() == 4
+    assert "2" not in r
+    program.run()
+    assert program.commands[2] == ("inc", "a")
+    assert r['a'] == 2
+    
+def test_register_file():
+    """Test the register file mapping view."""
+    r = RegisterFile.from_mapping(Registers.fromkeys("abcd", 0))
+    r['a'] = 7
+    assert r.slots == [7, 0, 0, 0]
+    assert dict(r) == {'a': 7, 'b': 0, 'c': 0, 'd': 0}
+    with pytest.raises(KeyError):
+        r['e'] = 1
+    r = parse(EXAMPLE_CMD.splitlines(), RegisterFile.fromkeys("abcd", 0))
+    assert r['a'] == 3
+    
+LOOP_CMDS = [
+    # Addition, with the counter decremented first.
+    ("cpy 5 c\ndec c\ninc a\njnz c -2", 1),
+    # Multiplication with the loops reordered.
+    ("cpy 4 b\ncpy 3 d\ncpy b c\ndec c\ninc a\njnz c -2\ndec d\njnz d -5", 2),
+    # Counting up to zero, with several accumulators.
+    ("cpy -6 d\ninc b\ninc d\ndec a\ninc b\njnz d -4", 1),
+    # Three nested loops.
+    ("cpy 2 e\ncpy 3 d\ncpy 4 c\ninc a\ndec c\njnz c -2\ndec d\njnz d -5\ndec e\njnz e -8", 1),
+    # Triangle numbers, only the inner loop is closed form.
+    ("cpy 4 c\ncpy c b\ninc a\ndec b\njnz b -2\ndec c\njnz c -5", 2),
+]
+
+@pytest.mark.parametrize("commands, head", LOOP_CMDS)
+def test_optimize_loop(commands, head):
+    """Test that optimized loops match plain execution."""
+    commands = commands.splitlines()
+    expected = Program(commands, RegisterFile.fromkeys("abcde", 0), optimize=False).run()
+    program = Program(commands, RegisterFile.fromkeys("abcde", 0))
+    assert optimize_loop(program.commands, head, program.registers.index) is not None
+    assert dict(program.run()) == dict(expected)
+    
+TOGGLE_LOOP_CMD = """
+cpy 4 c
+tgl 3
+inc a
+inc b
+inc c
+jnz c -3
+"""
+
+def test_toggle_loop():
+    """Test that toggling inside a loop recompiles only that loop."""
+    program = Program(TOGGLE_LOOP_CMD.splitlines(), RegisterFile.fromkeys("abcd", 0))
+    assert program.edges == {5: 2}
+    compiled = list(program.compiled)
+    program.toggle(4)
+    assert program.commands[4] == ("dec", "c")
+    changed = [ i for i, (a, b) in enumerate(zip(compiled, program.compiled)) if a is not b ]
+    assert changed == [2, 4]
+    program.toggle(4)
+    
+    r = program.run()
+    assert dict(r) == {'a': 4, 'b': 4, 'c': 0, 'd': 0}
+    
+def test_profile():
+    """Test profiling, with and without loop optimization."""
+    commands = LOOP_CMDS[-1][0].splitlines()
+    profile = Profile()
+    Program(commands, RegisterFile.fromkeys("abcd", 0), profile=profile).run()
+    assert profile.calls["loop"] == 4
+    assert profile.back_edges == {(6, 1): 3}
+    assert "[cpy c b; inc a; dec b; jnz b -2; dec c; jnz c -5]" in profile.report()
+    
+    profile = Profile()
+    Program(commands, RegisterFile.fromkeys("abcd", 0), optimize=False, profile=profile).run()
+    assert "loop" not in profile.calls
+    assert profile.back_edges[(4, 2)] == 6
+    
+def test_summarize_loop():
+    """Test the closed form of a multiplication."""
+    commands = [tuple(c.split()) for c in PUZZLE_CMD.strip().splitlines()]
+    back, values, guards = optimize_loop(commands, 4, "abcd")
+    assert back == 9
+    assert values == {'a': {('a',): 1, ('b', 'd'): 1}, 'c': {}, 'd': {}}
+    assert guards == [{('b',): 1}, {('d',): 1}]
+    
 PUZZLE_CMD = """
 cpy a b
 dec b